@@ -6,25 +6,35 @@ import hashlib
 import helpers
 import libunison.geometry as geometry
 import libunison.predict as predict
+import libunison.utils as utils
+import numpy as np
 import random
+import threading
 import time
-import re
-import math
 
 from constants import errors, events
 from flask import Blueprint, request, g, jsonify
 from libentry_views import set_rating
-from libunison.models import User, UserTags, Group, Track, LibEntry, GroupEvent, Cluster
-from operator import itemgetter
-from storm.expr import Desc, In
+from libunison.models import User, UserTags, Group, Track, GroupEvent, Cluster
+from storm.expr import Count, Desc, Func
 from storm.locals import AutoReload
 
 # Maximal number of groups returned when listing groups.
 MAX_GROUPS = 10
 
-# Maximal number of tracks returned when asking for the next tracks.
+# Default number of tracks returned when asking for the next tracks.
 MAX_TRACKS = 5
 
+# Maximal number of tracks that can be asked for at once (to prefetch).
+MAX_PREFETCH = 50
+
+# Length of the beginning of a model that holds its version.
+MODEL_HEAD = 32
+
+# Weights of the preferences and of the models when merging the rankings.
+PREF_WEIGHT = 0.75
+MODEL_WEIGHT = 0.25
+
 # Interval during which we don't play the same song again.
 ACTIVITY_INTERVAL = 60 * 60 * 5  # In seconds.
 
@@ -34,34 +44,141 @@ MIN_SUGGESTION_SIZE = 2
 #number of users of a newly created group, for now the group is created empty.
 NB_USERS_IN_NEW_GROUP = 0
 
+# Minimal time (in seconds) between two refreshes of the groups' index.
+GROUP_INDEX_REFRESH = 5
+# Groups updated up to this long before the last refresh are checked again,
+# in case their transaction was committed late.
+GROUP_INDEX_OVERLAP = datetime.timedelta(minutes=1)
+
+# Number of grid cells whose cluster is cached, and how long (in seconds) the
+# entries are kept. The number of users in the cluster is kept up to date by
+# the process, but the changes made by the other processes can be that much
+# late.
+CLUSTER_CACHE_SIZE = 100000
+CLUSTER_CACHE_TTL = 60
+
+# Get the cluster of a grid cell, or create it, and count its users.
+QUERY_UPSERT_CLUSTER = """WITH created AS (
+      INSERT INTO cluster (cell_id, position) VALUES (?, point(?, ?))
+      ON CONFLICT (cell_id) DO NOTHING
+      RETURNING id, group_id),
+    cluster_ AS (
+      SELECT id, group_id FROM created
+      UNION ALL
+      SELECT id, group_id FROM cluster WHERE cell_id = ?)
+    SELECT id, group_id,
+      (SELECT count(*) FROM "user" WHERE cluster_id = cluster_.id)
+    FROM cluster_ LIMIT 1"""
+QUERY_SELECT_CLUSTER = """SELECT id, group_id,
+      (SELECT count(*) FROM "user" WHERE cluster_id = cluster.id)
+    FROM cluster WHERE cell_id = ?"""
+
 group_views = Blueprint('group_views', __name__)
 
+# Cluster of the grid cells: cell ID => (cluster ID, group ID, nb. of users).
+_cluster_cache = utils.LRUCache(CLUSTER_CACHE_SIZE, ttl=CLUSTER_CACHE_TTL)
+
+# Spatial index of the groups that can be listed (active, and not automatic),
+# shared by the requests of the process.
+_group_index = geometry.GridIndex()
+_group_index_state = {'refreshed': 0, 'last_update': None}
+_group_index_lock = threading.Lock()
+
+
+def _refresh_group_index(store):
+    """Bring the groups' index up to date (with the lock held).
+
+    The first refresh loads all the listable groups, the next ones only the
+    groups updated since then (the update time of a group changes when it is
+    deactivated). Nothing is done if the index was refreshed recently.
+    """
+    state = _group_index_state
+    if time.time() - state['refreshed'] < GROUP_INDEX_REFRESH:
+        return
+    columns = (Group.id, Group.coordinates, Group.is_active,
+            Group.is_automatic, Group.updated)
+    if state['last_update'] is None:
+        rows = store.find(columns, Group.is_active,
+                Group.is_automatic == False)
+    else:
+        rows = store.find(columns,
+                Group.updated > state['last_update'] - GROUP_INDEX_OVERLAP)
+    for gid, coordinates, is_active, is_automatic, updated in rows:
+        if is_active and not is_automatic and coordinates is not None:
+            _group_index.add(gid, coordinates)
+        else:
+            _group_index.remove(gid)
+        if state['last_update'] is None or updated > state['last_update']:
+            state['last_update'] = updated
+    state['refreshed'] = time.time()
+
+
+def nearest_groups(store, point, k):
+    """Get the `k` listable groups that are nearest to a point.
+
+    Returns a list of (group ID, distance in meters), nearest first. The
+    groups are looked up in the in-memory index, which is refreshed at most
+    every GROUP_INDEX_REFRESH seconds.
+    """
+    with _group_index_lock:
+        _refresh_group_index(store)
+        return _group_index.nearest(point, k)
+
+
+def groups_within(store, point, radius):
+    """Get the listable groups at most `radius` meters away from a point.
+
+    Returns a list of (group ID, distance in meters), nearest first.
+    """
+    with _group_index_lock:
+        _refresh_group_index(store)
+        return _group_index.within(point, radius)
+
 
 @group_views.route('', methods=['GET'])
 @helpers.authenticate()
 def list_groups():
-    """Get a list of groups."""
-    userloc = None
+    """Get a list of groups.
+
+    Groups are sorted by distance to the user if a location is given, with
+    the newest groups first otherwise. Results are paginated (page 0 is the
+    first one).
+    """
+    try:
+        page = max(int(request.values.get('page', 0)), 0)
+    except ValueError:
+        raise helpers.BadRequest(errors.MISSING_FIELD, "cannot parse page")
+    start = page * MAX_GROUPS
     try:
         lat = float(request.values['lat'])
         lon = float(request.values['lon'])
     except (KeyError, ValueError):
         # Sort by descending ID - new groups come first.
-        key_fct = lambda r: -1 * r.id
+        rows = list(g.store.find(Group, Group.is_active,
+                Group.is_automatic == False).order_by(Desc(Group.id))[
+                start:start + MAX_GROUPS])
+        distances = dict()
     else:
-        # Sort the rows according to the distance from the user's location.
-        userloc = geometry.Point(lat, lon)
-        key_fct = lambda r: geometry.distance(userloc, r.coordinates)
+        # Nearest neighbors first, using the in-memory index.
+        nearest = nearest_groups(g.store, geometry.Point(lat, lon),
+                start + MAX_GROUPS)[start:]
+        distances = dict(nearest)
+        found = dict((group.id, group) for group in g.store.find(Group,
+                Group.id.is_in(distances.keys()), Group.is_active))
+        # The index might be a few seconds late, skip the groups that are gone.
+        rows = [found[gid] for gid, dist in nearest if gid in found]
+    # Count the members of all the groups at once.
+    counts = dict(g.store.find((User.group_id, Count()),
+            User.group_id.is_in([group.id for group in rows]))
+            .group_by(User.group_id))
     groups = list()
-    rows = sorted(g.store.find(Group, (Group.is_active) & (Group.is_automatic == False)), key=key_fct) # "not" doesn't work...
-    for group in rows[:MAX_GROUPS]:
+    for group in rows:
         groups.append({
           'gid': group.id,
           'name': group.name,
-          'nb_users': group.users.count(),
-          'distance': (geometry.distance(userloc, group.coordinates)
-                  if userloc is not None else None),
-    		  'password': group.password != None
+          'nb_users': counts.get(group.id, 0),
+          'distance': distances.get(group.id),
+          'password': group.password != None
         })
     return jsonify(groups=groups)
 
@@ -82,6 +199,12 @@ def create_group():
     group = Group(name, is_active=True)
     group.coordinates = geometry.Point(lat, lon)
     group = g.store.add(group)
+    group.id = AutoReload
+    g.store.commit()
+    # Make the group visible to the next listings of this process, once it
+    # is visible to the others.
+    with _group_index_lock:
+        _group_index.add(group.id, group.coordinates)
     
     
     askList = False
@@ -194,156 +317,160 @@ def get_group_info(gid):
     return jsonify(name=group.name, track=track, master=master, users=users)
 
 
-def get_played_filter(group):
-    played = set()
+def get_played_tracks(group):
+    """Get the IDs of the tracks played recently in the group."""
     threshold = datetime.datetime.fromtimestamp(
             time.time() - ACTIVITY_INTERVAL)
-    events = g.store.find(GroupEvent, (GroupEvent.group == group)
-        & (GroupEvent.event_type == u'play') & (GroupEvent.created > threshold))
-    for event in events:
-        info = (event.payload.get('artist'), event.payload.get('title'))
-        played.add(info)
-    def played_filter(entry):
-        info = (entry.track.artist, entry.track.title)
-        return info not in played
-    return played_filter
-
-
-def get_playlist_id(group):
-    # Find last event in the group that could have changed the playlist
-    events = g.store.find(GroupEvent, (GroupEvent.group == group)
-            & In(GroupEvent.event_type, [u'join', u'leave', u'master']))
-    last = events.order_by(Desc(GroupEvent.created)).first()
-    if last is not None:
-        when = last.created
-    else:
-        when = datetime.datetime.utcnow()
-    return unicode(hashlib.sha1(when.strftime('%s')).hexdigest())
+    return set(g.store.find(GroupEvent.track_id,
+            (GroupEvent.group_id == group.id)
+            & (GroupEvent.event_type == events.PLAY)
+            & (GroupEvent.created > threshold)
+            & (GroupEvent.track_id != None)))
+
+
+def get_preferences(group):
+    """Get the current preferences of the group's members."""
+    return [pref for pref in g.store.find(UserTags.preference,
+            (UserTags.id == User.id) & (User.group_id == group.id)) if pref]
+
+
+def get_playlist_key(group, prefs):
+    """Get a key describing everything the group's playlist depends on.
+
+    That is, the group's state version (its members and DJ), the versions of
+    the members' models and their preferences. Changes to the DJ's library
+    drop the cached playlist instead (see helpers.invalidate_playlist).
+    """
+    # The version is at the beginning of the model (see predict.encode_model).
+    heads = g.store.find((User.id, Func('substr', User.model, 1, MODEL_HEAD)),
+            User.group_id == group.id)
+    models = [(uid, predict.model_version(head)) for uid, head in heads]
+    return (group.state_version, tuple(sorted(models)), tuple(sorted(prefs)))
+
+
+def get_playlist_id(gid, version):
+    """Get the ID of a group's playlist, given the group's state version.
+
+    The ID changes whenever a member joins or leaves, or when the DJ changes.
+    """
+    return unicode(hashlib.sha1("%d:%d" % (gid, version)).hexdigest())
 
 
 @group_views.route('/<int:gid>/playlist', methods=['GET'])
 @helpers.authenticate(with_user=True)
 def get_playlist(master, gid):
     """Get the playlist id."""
-    group = g.store.get(Group, gid)
-    if group is None:
+    version = helpers.get_group_version(gid)
+    if version is None:
         raise helpers.BadRequest(errors.INVALID_GROUP,
                 "group does not exist")
-    id = get_playlist_id(group)
+    id = get_playlist_id(gid, version)
     return jsonify(playlist_id=id)
 
 
-@group_views.route('/<int:gid>/tracks', methods=['GET'])
-@helpers.authenticate(with_user=True)
-def get_tracks(master, gid):
-    """Get the next tracks."""
-    group = g.store.get(Group, gid)
-    if group is None:
-        raise helpers.BadRequest(errors.INVALID_GROUP,
-                "group does not exist")
-    if group.master != master:
-        raise helpers.Unauthorized("you are not the DJ")
-    # Get all the tracks in the master's library that haven't been played.
-    played_filter = get_played_filter(group)
-    remaining = filter(played_filter, g.store.find(LibEntry,
-            (LibEntry.user == master) & (LibEntry.is_valid == True)
-            & (LibEntry.is_local == True)))
-    if not remaining: # http://stackoverflow.com/questions/53513/python-what-is-the-best-way-to-check-if-a-list-is-empty
-        # Instead of removing the read tracks, reload all the tracks
-        remaining = g.store.find(LibEntry,
-            (LibEntry.user == master) & (LibEntry.is_valid == True)
-            & (LibEntry.is_local == True))
-        if not remaining:
-            raise helpers.NotFound(errors.TRACKS_DEPLETED, 'no tracks to play')
+def rank_tracks(group, master, prefs, k=None):
+    """Rank the tracks of the DJ's library for the group.
+
+    Returns the `k` best library entries (see predict.get_library), best
+    first, or all of them if k is None. The ranking stops as soon as the k
+    best tracks are known (see predict.merge_top_k).
+    """
+    library = predict.get_library(g.store, master)
     # Partition tracks based on whether we can embed them in the latent space.
-    with_feats = list()
-    points = list()
-    no_feats = list()
-    for entry in remaining:
-        point = predict.get_point(entry.track)
-        if point is not None:
-            with_feats.append(entry)
-            points.append(point)
-        else:
-            no_feats.append(entry)
+    with_feats, points = predict.library_points(library)
+    no_feats = [entry for entry in library if entry.features is None]
 
     #@author: Hieu
-    # Get users' current preferences
-    pref_users = [user.id for user in group.users if user is not None]
-    prefs = [usertags.preference for usertags in [g.store.get(UserTags,u) for u in pref_users] if usertags is not None and usertags.preference]
     prefs_features = [predict.get_tag_point(tag) for tag in prefs]
+    prefs_features = [ppref for ppref in prefs_features if ppref is not None]
     
     # The effect of current preferences 
     # calculate sum of dot products of every point with every tag/pref and group by point
-    prefs_ratings_agg = [sum([predict.score_by_tag(ppoint,ppref) for ppref in prefs_features if ppref is not None]) for ppoint in points]
+    if prefs_features:
+        prefs_ratings_agg = np.dot(points, np.sum(prefs_features, axis=0))
+    else:
+        prefs_ratings_agg = np.zeros(len(points))
     
-    # construct the playlist, decreasing order of preference scores
-    playlist_by_pref = [entry for entry, score in sorted(
-            zip(with_feats, prefs_ratings_agg), key=itemgetter(1), reverse=True)]
+    # rank the tracks, decreasing order of preference scores
+    ranking_by_pref = np.argsort(-prefs_ratings_agg, kind='mergesort')
     
     # For the users that can be modelled: predict their ratings.
     models = filter(lambda model: model.is_nontrivial(),
             [predict.Model(user) for user in group.users])
-    playlist_model = list()
     
     if len(models) > 0:
-        ratings = [model.score(points) for model in models]
-        # obsoleted
-        # agg = predict.aggregate(ratings)
-        
-        sorted_item_list_asc = [x for x in range(0,len(points))]
-        ranked_ratings = [[entry for entry, score in sorted(zip(sorted_item_list_asc,r), key=itemgetter(1), reverse=True)] for r in ratings]
-        
-        final_rank = list()
-        iter = 0
-        stop = False
-        while not stop and iter<10000:
-            transition_matrix = predict.transition_matrix(ranked_ratings,sorted_item_list_asc)
-            stationary = predict.markovchain4(transition_matrix)
-            addition = [entry for entry, score in sorted(zip(sorted_item_list_asc, stationary), key=itemgetter(1), reverse=True) if score>0]
-            final_rank = final_rank+addition
-            sorted_item_list_asc = [x for x in sorted_item_list_asc if x not in addition]
-            if not sorted_item_list_asc:
-                stop = True
-            iter = iter+1
-            ranked_ratings = [[x for x in r if x in sorted_item_list_asc] for r in ranked_ratings]
-            
-        if len(final_rank) < len(points):
-            final_rank = final_rank + sorted_item_list_asc
-        playlist_model = [with_feats[i] for i in final_rank]
+        # Log-densities of the tracks under each model, computed at once.
+        ratings = predict.score_many(models, points)
+        # Aggregate the members' rankings (Markov chain method, MC4).
+        passes = predict.mc4_iter(ratings)
     else:
         # Not a single user can be modelled! just order the songs randomly.
-        agg = range(len(with_feats))
-        random.shuffle(agg)
-        # Construct the playlist, decreasing order of scores.
-        playlist_model = [entry for entry, score in sorted(zip(with_feats, agg), key=itemgetter(1), reverse=True)]
-    
-    #@author: Hieu
-    # merge two playlists of preferences and models
-    entry_dict = dict()
-    weight = [0.75, 0.25]; #weight(preference,models)
-    
-    for i in range (0,len(playlist_model)):
-        entry_dict[playlist_model[i]] = weight[1]*(i+1)
-    for i in range (0,len(playlist_by_pref)):
-        entry_dict[playlist_by_pref[i]] += weight[0]*(i+1)
+        passes = [np.random.permutation(len(with_feats))]
     
-    playlist = [k[0] for k in sorted(entry_dict.iteritems(), key=itemgetter(1), reverse=False)]
+    # merge the rankings of preferences and models.
+    best = predict.merge_top_k(passes, ranking_by_pref, k,
+            PREF_WEIGHT, MODEL_WEIGHT)
+    playlist = [with_feats[i] for i in best]
     
     #@end-author: Hieu  
 
-    # Randomize songs for which we don't have features.
-    random.shuffle(no_feats)
-    playlist.extend(no_feats)
+    # Randomize songs for which we don't have features, they come last.
+    if len(playlist) == len(with_feats):
+        random.shuffle(no_feats)
+        playlist.extend(no_feats)
+        if k is not None:
+            playlist = playlist[:k]
+    # The playlist is cached, don't keep the features around.
+    return [entry._replace(features=None) for entry in playlist]
+
+
+@group_views.route('/<int:gid>/tracks', methods=['GET'])
+@helpers.authenticate(with_user=True)
+def get_tracks(master, gid):
+    """Get the next tracks."""
+    group = g.store.get(Group, gid)
+    if group is None:
+        raise helpers.BadRequest(errors.INVALID_GROUP,
+                "group does not exist")
+    if group.master != master:
+        raise helpers.Unauthorized("you are not the DJ")
+    try:
+        count = int(request.args.get('count', MAX_TRACKS))
+    except ValueError:
+        raise helpers.BadRequest(errors.MISSING_FIELD,
+                "cannot parse count")
+    count = max(1, min(MAX_PREFETCH, count))
+    # Only the best tracks are ranked: enough of them to skip the tracks that
+    # have been played recently. They are ranked by chunks of MAX_PREFETCH,
+    # so that the cached ranking lasts for a few plays.
+    played = get_played_tracks(group)
+    k = (count + len(played) + MAX_PREFETCH - 1) // MAX_PREFETCH * MAX_PREFETCH
+    # The ranking only changes with the group's state, so it is cached.
+    prefs = get_preferences(group)
+    playlist_id = get_playlist_id(group.id, group.state_version)
+    key = get_playlist_key(group, prefs)
+    playlist = helpers.get_cached_playlist(group.id, key, k)
+    if playlist is None:
+        playlist = rank_tracks(group, master, prefs, k)
+        # A shorter playlist is the whole library.
+        helpers.cache_playlist(group.id, key, playlist,
+                k if len(playlist) >= k else None)
+    # Skip the tracks that have been played recently.
+    remaining = [entry for entry in playlist if entry.track_id not in played]
+    if not remaining:
+        # Instead of removing the read tracks, reload all the tracks
+        remaining = playlist
+        if not remaining:
+            raise helpers.NotFound(errors.TRACKS_DEPLETED, 'no tracks to play')
     # Craft the JSON response.
     tracks = list()
-    for entry in playlist[:MAX_TRACKS]:
+    for entry in remaining[:count]:
         tracks.append({
-          'artist': entry.track.artist,
-          'title': entry.track.title,
+          'artist': entry.artist,
+          'title': entry.title,
           'local_id': entry.local_id,
         })
-    return jsonify(playlist_id=get_playlist_id(group), tracks=tracks)
+    return jsonify(playlist_id=playlist_id, tracks=tracks)
 
 
 @group_views.route('/<int:gid>/current', methods=['PUT'])
@@ -382,6 +509,7 @@ def play_track(user, gid):
           'predicted': True #if random.random() > 0.2 else False
         })
     event = GroupEvent(group, user, events.PLAY, payload)
+    event.track_id = track.id
     g.store.add(event)
     return helpers.success()
 
@@ -408,6 +536,7 @@ def skip_track(user, gid):
       'master': {'uid': user.id, 'nickname': user.nickname},
     }
     event = GroupEvent(group, user, events.SKIP, payload)
+    event.track_id = play_event.track_id
     g.store.add(event)
     return helpers.success()
 
@@ -444,6 +573,7 @@ def add_rating(user, gid):
      'title': track.title,
      'rating': rating,
     }
+    event.track_id = track.id
     g.store.add(event)
     # Add a library entry.
     set_rating(user, track.artist, track.title, rating)
@@ -470,6 +600,7 @@ def set_master(user, gid):
     group.master = user
     event = GroupEvent(group, user, events.MASTER, None)
     g.store.add(event)
+    helpers.bump_group_version(group)
     return helpers.success()
 
 
@@ -484,9 +615,34 @@ def leave_master(user, gid):
     if group.master != None and group.master != user:
         raise helpers.Unauthorized("you are not the master")
     group.master = None
+    helpers.bump_group_version(group)
     return helpers.success()
 
 
+def get_cluster(store, cell, position):
+    """Get the (ID, group ID, number of users) of the cluster of a grid cell.
+
+    The cluster is created if needed, with a single query. The result is
+    cached (see CLUSTER_CACHE_TTL).
+    """
+    entry = store.execute(QUERY_UPSERT_CLUSTER,
+            (cell, position.lat, position.lon, cell)).get_one()
+    if entry is None:
+        # The cluster was created concurrently, after our query started.
+        entry = store.execute(QUERY_SELECT_CLUSTER, (cell,)).get_one()
+    _cluster_cache.put(cell, entry)
+    return entry
+
+
+def leave_cluster(store, cid):
+    """Update the cached number of users of a cluster that a user left."""
+    old_cell = store.find(Cluster.cell_id, Cluster.id == cid).one()
+    entry = _cluster_cache.get(old_cell)
+    if entry is not None and entry[0] == cid:
+        _, gid, size = entry
+        _cluster_cache.put(old_cell, (cid, gid, max(size - 1, 0)))
+
+
 # added by Vincent and Louis
 @group_views.route('/suggestion', methods=['GET'])
 @helpers.authenticate(with_user=True)
@@ -498,39 +654,28 @@ def send_suggest(user):
         raise helpers.BadRequest(errors.MISSING_FIELD,
                 "cannot parse lat and lon")
 
-    #TODO: only remove and add if necessary
-    
-
     # Get user's location to put him in a cluster.
     user_loc = geometry.Point(lat, lon)
     cluster_loc = geometry.map_location_on_grid(user_loc)
-    clusterRequest = g.store.execute("SELECT * FROM \"cluster\" WHERE position ~= CAST ('("+str(cluster_loc.lat)+","+str(cluster_loc.lon)+")' AS point)")
-    clusterResult = clusterRequest.get_one()
-    clusterRequest.close() # close the cursor in DB
-
-
-    if clusterResult is None:
-        cluster = Cluster(cluster_loc)
-        cluster = g.store.add(cluster)
-        cluster.id = AutoReload
+    cell = geometry.cell_id(user_loc)
+    entry = _cluster_cache.get(cell)
+    if entry is None:
+        entry = get_cluster(g.store, cell, cluster_loc)
+    cid, gid, size = entry
+    if user.cluster_id != cid:
+        if user.cluster_id is not None:
+            leave_cluster(g.store, user.cluster_id)
+        user.cluster_id = cid
+        size += 1
+        _cluster_cache.put(cell, (cid, gid, size))
     else:
-        coordinatesList = re.split('[\(,\)]', clusterResult[1])
-    #CAUTION: format is ('', 'lat', 'lon', '')
-#    cluster = Cluster(geometry.Point(float(coordinatesList[1]), float(coordinatesList[2])))
-#    cluster.id = clusterResult[0]
-#    cluster.group_id = clusterResult[2]
-
-        #now we get the cluster by its ID because otherwise the store doesn't seem to be properly set for this cluster
-        cluster = g.store.get(Cluster, clusterResult[0] )
-
-    
-    user.cluster_id = cluster.id
-#    usersInCluster = g.store.find(User, (User.cluster_id == cluster.id))
-    usersInCluster = cluster.users
-    size = usersInCluster.count()
+        # The user is in the cluster, even if the cached count is stale.
+        size = max(size, 1)
     if size < MIN_SUGGESTION_SIZE:
-        return jsonify(suggestion=False, clusterId=cluster.id)
+        return jsonify(suggestion=False, clusterId=cid)
     else:
+        cluster = g.store.get(Cluster, cid)
+        usersInCluster = cluster.users
         #Create group for cluster if needed:
         if cluster.group_id is None:
             groupName = u''
@@ -543,6 +688,7 @@ def send_suggest(user):
             clusterGroup.name = u'AutoGroup ' + str(clusterGroup.id) #result type is "unicode"
             #tie the group with the cluster
             cluster.group_id = clusterGroup.id
+            _cluster_cache.put(cell, (cid, clusterGroup.id, size))
         else:
             clusterGroup = g.store.get(Group, cluster.group_id)
         #Retrieve users already in cluster:
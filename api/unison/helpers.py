@@ -2,12 +2,111 @@
 
 import base64
 import functools
+import hashlib
+import hmac
 import libunison.password as password
+import libunison.utils as utils
+import os
 import werkzeug.exceptions
 
 from constants import errors
 from flask import Response, jsonify, request, g
-from libunison.models import User
+from libunison.models import Group, User
+
+
+AUTH_CACHE_SIZE = 10000  # Number of credentials kept in the cache.
+AUTH_CACHE_TTL = 300  # Time (in seconds) during which they are trusted.
+
+PLAYLIST_CACHE_SIZE = 1000  # Number of groups whose playlist is cached.
+PLAYLIST_CACHE_TTL = 60 * 60  # In seconds.
+
+GROUP_VERSION_CACHE_SIZE = 10000  # Number of groups whose version is cached.
+# Time (in seconds) during which the cached versions are used. Changes made
+# by other processes can be noticed that late.
+GROUP_VERSION_CACHE_TTL = 2
+
+# Successful verifications (see check_password). Keys are MACs of the
+# credentials under a secret of the process, so the cache never holds them in
+# the clear. Values are the password hashes that were matched.
+_auth_cache = utils.LRUCache(AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+_auth_secret = os.urandom(32)
+
+# Ranked playlists of the groups (see group_views.get_tracks), by group ID.
+# Values are (key, k, playlist) triples, where the key describes everything
+# the ranking depends on, and k is the number of tracks that were ranked
+# (None if the whole library was).
+_playlist_cache = utils.LRUCache(PLAYLIST_CACHE_SIZE, ttl=PLAYLIST_CACHE_TTL)
+
+# State versions of the groups (see get_group_version), by group ID.
+_group_versions = utils.LRUCache(GROUP_VERSION_CACHE_SIZE,
+        ttl=GROUP_VERSION_CACHE_TTL)
+
+
+def check_password(user, pw):
+    """Check the password of a user.
+
+    PBKDF2 is (on purpose) slow, so successful verifications are cached for a
+    few minutes. A cached verification is only valid as long as the user's
+    password hash doesn't change, i.e. changing the password invalidates it.
+    Outdated hashes are replaced after a successful verification.
+    """
+    credentials = (u"%s\0%s" % (user.email, pw)).encode('utf-8')
+    key = hmac.new(_auth_secret, credentials, hashlib.sha256).digest()
+    if _auth_cache.get(key) == user.password:
+        return True
+    if password.verify(pw, user.password):
+        if password.needs_rehash(user.password):
+            user.password = password.encrypt(pw)
+        _auth_cache.put(key, user.password)
+        return True
+    return False
+
+
+def get_cached_playlist(gid, key, k=None):
+    """Get the cached playlist of a group, if it was ranked for this key and
+    has (at least) its `k` best tracks (all of them if k is None)."""
+    cached = _playlist_cache.get(gid)
+    if cached is None or cached[0] != key:
+        return None
+    if cached[1] is not None and (k is None or cached[1] < k):
+        return None
+    return cached[2]
+
+
+def cache_playlist(gid, key, playlist, k=None):
+    _playlist_cache.put(gid, (key, k, playlist))
+
+
+def invalidate_playlist(gid):
+    """Drop the cached playlist of a group, e.g. when a preference changes."""
+    if gid is not None:
+        _playlist_cache.discard(gid)
+
+
+def get_group_version(gid):
+    """Get the state version of a group (None if the group doesn't exist).
+
+    The version is read from the cache, or with a primary key lookup.
+    """
+    version = _group_versions.get(gid)
+    if version is None:
+        version = g.store.find(Group.state_version, Group.id == gid).one()
+        if version is not None:
+            _group_versions.put(gid, version)
+    return version
+
+
+def bump_group_version(group):
+    """Record a change of the group's state (its members or its DJ).
+
+    The version is incremented atomically by the database when the store is
+    flushed.
+    """
+    if group is None:
+        return
+    group.state_version = Group.state_version + 1
+    _group_versions.discard(group.id)
+    invalidate_playlist(group.id)
 
 
 def authenticate(with_user=False):
@@ -26,7 +125,7 @@ def authenticate(with_user=False):
             user = g.store.find(User, User.email == email).one()
             if user is None:
                 raise Unauthorized()
-            if not password.verify(pw, user.password):
+            if not check_password(user, pw):
                 raise Unauthorized()
             if with_user:
                 return fn(user, *args, **kwargs)
@@ -1,62 +1,164 @@
 #!/usr/bin/env python
 """Library entry related views."""
 
+import collections
 import helpers
 import hashlib
 import json
-import libunison.predict as predict
-import pika
+import libunison.jobs as jobs
+import libunison.publisher as publisher
 
 from constants import errors
 from flask import Blueprint, request, g, jsonify
 from libunison.models import User, Group, Track, LibEntry, GroupEvent
 
 
+# Maximal number of rows per statement when ingesting a library in bulk.
+BULK_SIZE = 1000
+
+# Create the tracks that don't exist yet, returns the new ones.
+QUERY_INSERT_TRACKS = """INSERT INTO track (artist, title) VALUES %s
+    ON CONFLICT (artist, title) DO NOTHING RETURNING artist, title"""
+QUERY_SELECT_TRACKS = """SELECT track.id, track.artist, track.title
+    FROM track JOIN (VALUES %s) AS v(artist, title)
+    ON track.artist = v.artist AND track.title = v.title"""
+QUERY_INSERT_ENTRIES = """INSERT INTO lib_entry
+    (user_id, track_id, local_id, valid, local) VALUES %s"""
+QUERY_MAKE_LOCAL = """UPDATE lib_entry SET local = TRUE, local_id = v.local_id
+    FROM (VALUES %s) AS v(id, local_id) WHERE lib_entry.id = v.id"""
+QUERY_INVALIDATE = "UPDATE lib_entry SET valid = FALSE WHERE id IN (%s)"
+
 libentry_views = Blueprint('libentry_views', __name__)
 
 
+def entry_key(artist, title, local_id):
+    return hashlib.sha1(artist.encode('utf-8')
+            + title.encode('utf-8') + str(local_id)).digest()
+
+
 def local_valid_entries(user):
+    """Get the IDs of the user's local, valid entries, by key (see
+    entry_key)."""
     entrydict = dict()
-    rows = g.store.find(LibEntry, (LibEntry.user == user)
-            & LibEntry.is_local & LibEntry.is_valid)
-    for lib_entry in rows:
-        key = hashlib.sha1(lib_entry.track.artist.encode('utf-8')
-                + lib_entry.track.title.encode('utf-8')
-                + str(lib_entry.local_id)).digest()
-        entrydict[key] = lib_entry
+    rows = g.store.find((LibEntry.id, Track.artist, Track.title,
+            LibEntry.local_id), LibEntry.user == user, LibEntry.is_local,
+            LibEntry.is_valid, LibEntry.track_id == Track.id)
+    for eid, artist, title, local_id in rows:
+        entrydict[entry_key(artist, title, local_id)] = eid
     return entrydict
 
 
+def _chunks(items, size=BULK_SIZE):
+    for i in xrange(0, len(items), size):
+        yield items[i:i+size]
+
+
+def _values(row, nb_rows):
+    """Placeholders for a VALUES list of `nb_rows` rows."""
+    return ", ".join([row] * nb_rows)
+
+
+def get_tracks(pairs):
+    """Get the IDs of the tracks, given their (artist, title) pairs.
+
+    The tracks that don't exist yet are created. Returns a dictionary mapping
+    the pairs to the IDs, and the list of new pairs (see init_tracks).
+    """
+    ids = dict()
+    created = list()
+    for chunk in _chunks(pairs):
+        values = _values("(?, ?)", len(chunk))
+        params = [x for pair in chunk for x in pair]
+        created.extend(tuple(row) for row in g.store.execute(
+                QUERY_INSERT_TRACKS % values, params))
+        for tid, artist, title in g.store.execute(
+                QUERY_SELECT_TRACKS % values, params):
+            ids[(artist, title)] = tid
+    return ids, created
+
+
+def add_lib_entries(user, entries):
+    """Add local entries to the user's library, in bulk.
+
+    `entries` is a list of (artist, title, local_id) triples. The result is
+    the same as calling set_lib_entry on each of them, but the number of
+    queries doesn't depend on the number of entries. Returns the list of
+    tracks that were created, to be initialized (see init_tracks) once they
+    are committed.
+    """
+    # If a track appears several times, only the last entry remains valid.
+    local_ids = collections.OrderedDict()
+    for artist, title, local_id in entries:
+        local_ids[(artist, title)] = local_id
+    if len(local_ids) == 0:
+        return list()
+    ids, created = get_tracks(local_ids.keys())
+    # The user's current entries for these tracks.
+    current = dict()
+    for tids in _chunks(list(set(ids.values()))):
+        current.update((tid, (eid, is_local)) for eid, tid, is_local
+                in g.store.find((LibEntry.id, LibEntry.track_id,
+                LibEntry.is_local), LibEntry.user == user, LibEntry.is_valid,
+                LibEntry.track_id.is_in(tids)))
+    new_entries = list()
+    make_local = list()
+    invalid = list()
+    for pair, local_id in local_ids.iteritems():
+        tid = ids[pair]
+        eid, is_local = current.get(tid, (None, None))
+        if eid is not None and not is_local:
+            # User already has a (non-local) entry. Just make it local.
+            make_local.append((eid, local_id))
+        else:
+            if eid is not None:
+                # Invalidate the entry before creating a new one.
+                invalid.append(eid)
+            new_entries.append((user.id, tid, local_id))
+    for chunk in _chunks(make_local):
+        g.store.execute(QUERY_MAKE_LOCAL % _values("(?, ?)", len(chunk)),
+                [x for row in chunk for x in row])
+    invalidate_lib_entries(invalid)
+    for chunk in _chunks(new_entries):
+        g.store.execute(QUERY_INSERT_ENTRIES
+                % _values("(?, ?, ?, TRUE, TRUE)", len(chunk)),
+                [x for row in chunk for x in row])
+    return created
+
+
+def invalidate_lib_entries(eids):
+    """Invalidate library entries, given their IDs."""
+    for chunk in _chunks(list(eids)):
+        g.store.execute(QUERY_INVALIDATE % _values("?", len(chunk)), chunk)
+
+
+def init_tracks(pairs):
+    """Initialize new tracks, given their (artist, title) pairs.
+
+    To be used when creating new tracks. In concrete terms, this function
+    generates and sends the jobs that will fetch the tracks' tags and other
+    information (see libunison.publisher).
+    """
+    publisher.get_publisher(g.config).publish(
+            publisher.track_messages(pairs))
+
+
 def init_track(track):
-    """Initialize a new track.
+    """Initialize a new track (see init_tracks)."""
+    init_tracks([(track.artist, track.title)])
 
-    To be used when creating a new track. In concrete terms, this function
-    generates and sends the jobs that will fetch the track's tags and other
-    information.
+
+def update_model(user, changes=None):
+    """Schedule the (re)training of the user's model.
+
+    The model is fitted in the background, the previous one is used in the
+    meantime. `changes` is the number of library entries that were added or
+    removed (None if unknown). We commit first, so that the library changes
+    are visible when the job is processed.
     """
-    meta = {'artist': track.artist, 'title': track.title}
-    tags_msg = json.dumps({
-      'action': 'track-tags',
-      'track': meta,
-    })
-    info_msg = json.dumps({
-      'action': 'track-info',
-      'track': meta,
-    })
-    # Set up the connection.
-    queue = g.config['queue']['name']
-    conn = pika.BlockingConnection(
-            pika.ConnectionParameters(g.config['queue']['host']))
-    channel = conn.channel()
-    # Creates the queue if it doesn't exist yet.
-    channel.queue_declare(queue=queue, durable=True)
-    # Send the messages to the queue.
-    channel.basic_publish(exchange='', routing_key=queue, body=tags_msg,
-            properties=pika.BasicProperties(delivery_mode=2))
-    channel.basic_publish(exchange='', routing_key=queue, body=info_msg,
-            properties=pika.BasicProperties(delivery_mode=2))
-    # Closing the connection flushes all the messages.
-    conn.close()
+    g.store.commit()
+    jobs.get_queue(g.config, g.store).push(user.id, changes)
+    # The user's library might be the one the group's DJ plays from.
+    helpers.invalidate_playlist(user.group_id)
 
 
 def set_lib_entry(user, artist, title, local_id=None, rating=None):
@@ -129,6 +231,7 @@ def dump_library(user, uid):
     helpers.ensure_users_match(user, uid)
     current_entries = local_valid_entries(user)
     next_entries = set()
+    added = list()
     for json_entry in request.form.getlist('entry'):
         try:
             entry = json.loads(json_entry)
@@ -138,18 +241,18 @@ def dump_library(user, uid):
         except:
             raise helpers.BadRequest(errors.INVALID_LIBENTRY,
                     "not a valid library entry")
-        key = hashlib.sha1(artist.encode('utf-8')
-                + title.encode('utf-8') + str(local_id)).digest()
+        key = entry_key(artist, title, local_id)
+        if key not in current_entries and key not in next_entries:
+            added.append((artist, title, local_id))
         next_entries.add(key)
-        if key not in current_entries:
-            set_lib_entry(user, artist, title, local_id=local_id)
+    created = add_lib_entries(user, added)
     # Invalidate entries that are not in the request.
-    for key, entry in current_entries.iteritems():
-        if key not in next_entries:
-            entry.is_valid = False
-    # Update the user's model.
-    g.store.flush()
-    predict.Model(user).generate(g.store)
+    removed = [eid for key, eid in current_entries.iteritems()
+            if key not in next_entries]
+    invalidate_lib_entries(removed)
+    # Update the user's model (this commits the changes).
+    update_model(user, len(added) + len(removed))
+    init_tracks(created)
     return helpers.success()
 
 
@@ -159,6 +262,8 @@ def update_library(user, uid):
     """Update (add or delete) a user's library."""
     helpers.ensure_users_match(user, uid)
     current_entries = local_valid_entries(user)
+    added = collections.OrderedDict()
+    removed = set()
     for json_delta in request.form.getlist('delta'):
         try:
             delta = json.loads(json_delta)
@@ -169,21 +274,22 @@ def update_library(user, uid):
         except:
             raise helpers.BadRequest(errors.INVALID_DELTA,
                     "not a valid library delta")
-        key = hashlib.sha1(artist.encode('utf-8')
-                + title.encode('utf-8') + str(local_id)).digest()
+        key = entry_key(artist, title, local_id)
         if delta_type == 'PUT':
             if key not in current_entries:
-                set_lib_entry(user, artist, title, local_id=local_id)
+                added[key] = (artist, title, local_id)
         elif delta_type == 'DELETE':
             if key in current_entries:
-                current_entries[key].is_valid = False
+                removed.add(current_entries[key])
         else:
             # Unknown delta type.
             raise helpers.BadRequest(errors.INVALID_DELTA,
                     "not a valid library delta")
-    # Update the user's model.
-    g.store.flush()
-    predict.Model(user).generate(g.store)
+    created = add_lib_entries(user, added.values())
+    invalidate_lib_entries(removed)
+    # Update the user's model (this commits the changes).
+    update_model(user, len(added) + len(removed))
+    init_tracks(created)
     return helpers.success()
 
 
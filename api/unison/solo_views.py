@@ -13,6 +13,7 @@ import copy
 
 import json
 import libunison.utils as utils
+import numpy as np
 
 from constants import errors
 from flask import Blueprint, request, g, jsonify
@@ -372,22 +373,28 @@ def pl_generator(user_id, seeds, options = None):
     if title is None:
         title = default_title
 
-    # Fetch LibEntries
+    # Fetch LibEntries (along with their tracks)
     if unrated:
-        entries = g.store.find(LibEntry, (LibEntry.user_id == user_id) & LibEntry.is_valid & LibEntry.is_local)
+        entries = predict.get_library(g.store, user_id)
     else:
         # TODO find if possibility to filter on existing result set entries.
-        entries = g.store.find(LibEntry, (LibEntry.user_id == user_id) & LibEntry.is_valid & LibEntry.is_local & (LibEntry.rating != None) & (LibEntry.rating > 0))
-    if entries.any() is not None and entries.any():
+        entries = predict.get_library(g.store, user_id, (LibEntry.rating != None) & (LibEntry.rating > 0))
+    if entries:
+        # Decode the feature vectors of all the tracks at once.
+        tagvects = utils.decode_features_many([entry.features
+                for entry in entries if entry.features is not None])
+        tagvects = tagvects.astype(np.float64)
+        # Not sure if tagvects are normalized, so in doubt normalize them.
+        norms = np.sqrt(np.sum(tagvects * tagvects, axis=1))
+        norms[norms == 0] = 1
+        # Compute cosine similarity (dot product), and "normalize" it in [0,1]
+        proximities = iter((np.fabs(np.dot(tagvects / norms[:, np.newaxis],
+                refvect[:tagvects.shape[1]])) + 1) / 2)
         for entry in entries:
             added = False
             proximity=0 # 0=far away, 1=identical
-            if entry.track.features is not None:
-                tagvect = utils.decode_features(entry.track.features)
-                # Not sure if tagvect is normalized, so in doubt normalize it.
-                tagvect = normalize(tagvect)
-                # Compute cosine similarity (dot product), and "normalize" it in [0,1]
-                proximity = sum( [ fabs(sum([refvect[i] * tagvect[i] for i in range(len(tagvect))])), 1 ] ) / 2
+            if entry.features is not None:
+                proximity = float(next(proximities))
                 # TODO optimization: filter ASAP, to avoid useless computations
                 # Ideal: filter at find() time
                 
@@ -443,8 +450,8 @@ def pl_generator(user_id, seeds, options = None):
             index = 1 # First index
             for entry in playlist:
                 tracks.append({
-                  'artist': entry.track.artist,
-                  'title': entry.track.title,
+                  'artist': entry.artist,
+                  'title': entry.title,
                   'local_id': entry.local_id,
                   'play_order': index # Postion of the track in the playlist, used by android
                 })
@@ -452,7 +459,7 @@ def pl_generator(user_id, seeds, options = None):
             
             # Store the playlist in the playlist table
             jsonify(tracks=tracks)
-            pldb = Playlist(user_id, unicode(title), len(playlist), seeds, options, unicode(refvect), tracks)
+            pldb = Playlist(user_id, unicode(title), len(playlist), seeds, options, refvect, tracks)
             g.store.add(pldb)
             g.store.flush() # See Storm Tutorial: https://storm.canonical.com/Tutorial#Flushing
             if title == default_title:
@@ -2,14 +2,13 @@
 """Main API controller."""
 
 import helpers
+import libunison.lifecycle as lifecycle
 import libunison.mail as mail
 import time
-import yaml
 
 from constants import errors
 from flask import Flask, request, g, Response, jsonify
 from libunison.models import User
-from storm.locals import create_database, Store
 
 # Blueprints.
 from user_views import user_views
@@ -29,22 +28,7 @@ app.register_blueprint(libentry_views, url_prefix='/libentries')
 app.register_blueprint(solo_views, url_prefix='/solo')
 
 
-@app.before_request
-def setup_request():
-    # Read the configuration.
-    stream = open('%s/config.yaml' % request.environ['UNISON_ROOT'])
-    g.config = yaml.load(stream)
-    # Set up the database.
-    database = create_database(g.config['database']['string'])
-    g.store = Store(database)
-
-
-@app.after_request
-def teardown_request(response):
-    # Commit & close the database connection.
-    g.store.commit()
-    g.store.close()
-    return response
+lifecycle.init_app(app)
 
 
 @app.errorhandler(401)
@@ -106,6 +106,7 @@ def update_user_preference(user, uid):
         g.store.add(usertags)
     else:
         usertags.preference = pref
+    helpers.invalidate_playlist(user.group_id)
     return helpers.success()
 
 # @end-author: Hieu
@@ -225,6 +226,7 @@ def leave_group(user):
             user.group.master = None
         event = GroupEvent(user.group, user, events.LEAVE, None)
         g.store.add(event)
+        helpers.bump_group_version(user.group)
     user.group = None
 
 
@@ -266,6 +268,8 @@ def update_user_group(user, uid):
             raise helpers.Forbidden("received an invalid group password")
             
     if user.group != group:
+        helpers.bump_group_version(user.group)
+        helpers.bump_group_version(group)
         if user.group is not None:
             if user.group.master == user:
                 # The user was his old group's master.
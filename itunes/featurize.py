@@ -9,26 +9,26 @@ from storm.expr import Eq, Ne
 
 
 DEFAULT_DB = 'gen/itunes.db'
+CHUNK_SIZE = 1000  # Number of tracks featurized at once.
 
 
 def fill_features(store):
-    conn = uutils.get_feature_db()
-    @uutils.memo
-    def tag_fct(tag):
-        return uutils.tag_features(tag, conn=conn, normalize=True)
-    for track in store.find(Track, Ne(Track.tags, None)
-            & Eq(Track.features, None)):
-        print "Processing %s - %s ..." % (track.artist, track.title)
-        if isinstance(track.tags, basestring):
-            continue
-        features = uutils.track_features(
-                track.tags, conn=conn, tag_fct=tag_fct)
-        if features is None:
-            # The track probably didn't have any tags.
-            print "-- Feature vector is null."
-            continue
-        # Serialize and save the feature vector.
-        track.features = uutils.encode_features(features)
+    space = uutils.get_tag_space()
+    tracks = [track for track in store.find(Track, Ne(Track.tags, None)
+            & Eq(Track.features, None))
+            if not isinstance(track.tags, basestring)]
+    for i in xrange(0, len(tracks), CHUNK_SIZE):
+        chunk = tracks[i:i+CHUNK_SIZE]
+        vectors = uutils.track_features_many(
+                [track.tags for track in chunk], space, normalize=True)
+        for track, features in zip(chunk, vectors):
+            print "Processing %s - %s ..." % (track.artist, track.title)
+            if features is None:
+                # The track probably didn't have any tags.
+                print "-- Feature vector is null."
+                continue
+            # Serialize and save the feature vector.
+            track.features = uutils.encode_features(features)
         store.commit()
 
 
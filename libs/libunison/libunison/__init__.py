@@ -1 +1,2 @@
-__all__ = ["utils", "models", "password", "mail", "geometry", "predict"]
+__all__ = ["utils", "models", "password", "mail", "geometry", "predict", "jobs",
+        "lifecycle", "publisher"]
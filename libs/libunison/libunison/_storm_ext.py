@@ -2,6 +2,8 @@
 
 import re
 import geometry
+import numpy as np
+import utils
 
 from storm.variables import Variable
 from storm.properties import SimpleProperty
@@ -40,3 +42,38 @@ class PointVariable(Variable):
 
 class Point(SimpleProperty):
     variable_class = PointVariable
+
+
+class FeaturesVariable(Variable):
+    """Feature vector stored as raw big-endian 4-byte floats (bytea).
+
+    Reading the property returns a read-only float32 numpy view of the raw
+    data, without any copy. Base64-encoded strings (the old text format, see
+    utils.encode_features) are still accepted, both from the database and
+    when setting the value.
+    """
+    __slots__ = ()
+
+    def parse_set(self, value, from_db):
+        if isinstance(value, unicode):
+            try:
+                return utils.b64dec(value)
+            except TypeError:
+                raise TypeError("Expected features, found %s" % repr(value))
+        if isinstance(value, (str, buffer)):
+            return value
+        if from_db:
+            raise TypeError("Expected features, found %s" % repr(value))
+        try:
+            return np.asarray(value, dtype=utils.FEATURES_DTYPE).tostring()
+        except (TypeError, ValueError):
+            raise TypeError("Expected features, found %s" % repr(value))
+
+    def parse_get(self, value, to_db):
+        if to_db:
+            return buffer(value)
+        return np.frombuffer(value, dtype=utils.FEATURES_DTYPE)
+
+
+class Features(SimpleProperty):
+    variable_class = FeaturesVariable
@@ -2,8 +2,9 @@
 """Geometrical stuff."""
 
 import collections
+import numpy as np
 
-from math import atan2, cos, pi, sin, sqrt, floor, fabs
+from math import atan2, ceil, cos, pi, sin, sqrt, floor, fabs
 
 # Mean earth radius in meters, according to
 # http://en.wikipedia.org/wiki/Earth_radius#Mean_radius
@@ -47,6 +48,142 @@ def distance(a, b, radius=EARTH_RADIUS):
     return radius * (2 * atan2(sqrt(x), sqrt(1 - x)))
 
 
+def distance_many(point, lats, lons, radius=EARTH_RADIUS):
+    """Compute the great-circle distances between a point and many others.
+
+    Vectorized version of `distance`: the other points are given as arrays of
+    latitudes and longitudes (in degrees), and an array of distances (in
+    meters) is returned.
+    """
+    lats = np.radians(np.asarray(lats, dtype=float))
+    lons = np.radians(np.asarray(lons, dtype=float))
+    lat = deg_to_rad(point.lat)
+    x = (np.sin((lats - lat) / 2.0)**2 + np.sin(
+            (lons - deg_to_rad(point.lon)) / 2.0)**2 * cos(lat) * np.cos(lats))
+    # Rounding errors can push x slightly out of [0, 1].
+    x = np.clip(x, 0.0, 1.0)
+    return radius * (2 * np.arctan2(np.sqrt(x), np.sqrt(1 - x)))
+
+
+def pairwise_distances(lats1, lons1, lats2=None, lons2=None,
+        radius=EARTH_RADIUS):
+    """Compute the great-circle distances between two sets of points.
+
+    Returns a matrix whose entry (i, j) is the distance (in meters) between
+    the i-th point of the first set and the j-th point of the second one. If
+    the second set is omitted, the distances within the first set are
+    computed.
+    """
+    if lats2 is None:
+        lats2, lons2 = lats1, lons1
+    lats1 = np.radians(np.asarray(lats1, dtype=float))[:, np.newaxis]
+    lons1 = np.radians(np.asarray(lons1, dtype=float))[:, np.newaxis]
+    lats2 = np.radians(np.asarray(lats2, dtype=float))[np.newaxis, :]
+    lons2 = np.radians(np.asarray(lons2, dtype=float))[np.newaxis, :]
+    x = (np.sin((lats2 - lats1) / 2.0)**2
+            + np.sin((lons2 - lons1) / 2.0)**2 * np.cos(lats1) * np.cos(lats2))
+    x = np.clip(x, 0.0, 1.0)
+    return radius * (2 * np.arctan2(np.sqrt(x), np.sqrt(1 - x)))
+
+
+class GridIndex(object):
+    """In-memory spatial index, on a uniform latitude / longitude grid.
+
+    Maps keys (e.g. group IDs) to points. Each cell of the grid covers
+    `cell_size` degrees in both directions, and holds the keys of the points
+    that fall into it, so that queries only look at the cells close to the
+    query point. Not thread-safe.
+    """
+
+    def __init__(self, cell_size=1.0):
+        self._cell_size = float(cell_size)
+        self._nb_lon_cells = int(np.ceil(360.0 / cell_size))
+        self._points = dict()
+        self._cells = collections.defaultdict(set)
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, key):
+        return key in self._points
+
+    def add(self, key, point):
+        """Add a point to the index (or move it, if the key exists)."""
+        self.remove(key)
+        self._points[key] = point
+        self._cells[self._cell(point.lat, point.lon)].add(key)
+
+    def remove(self, key):
+        """Remove a point from the index, if it is there."""
+        point = self._points.pop(key, None)
+        if point is not None:
+            cell = self._cell(point.lat, point.lon)
+            self._cells[cell].discard(key)
+            if len(self._cells[cell]) == 0:
+                del self._cells[cell]
+
+    def within(self, point, radius):
+        """Find the points that are at most `radius` meters away.
+
+        Returns a list of (key, distance) pairs, nearest first.
+        """
+        # Latitude span of the radius, in degrees.
+        span = rad_to_deg(float(radius) / EARTH_RADIUS)
+        lat_first = int(floor((point.lat - span) / self._cell_size))
+        lat_last = int(floor((point.lat + span) / self._cell_size))
+        # Longitude span, at the highest latitude covered.
+        top = fabs(point.lat) + span
+        lon_cells = None  # Every longitude.
+        if top < 90:
+            lon_span = span / cos(deg_to_rad(top))
+            first = int(floor((point.lon + 180 - lon_span) / self._cell_size))
+            last = int(floor((point.lon + 180 + lon_span) / self._cell_size))
+            if last - first + 1 < self._nb_lon_cells:
+                lon_cells = [j % self._nb_lon_cells
+                        for j in xrange(first, last + 1)]
+        keys = list()
+        if (lon_cells is not None
+                and (lat_last - lat_first + 1) * len(lon_cells)
+                    < len(self._cells)):
+            # Few cells to look at: visit them.
+            for i in xrange(lat_first, lat_last + 1):
+                for j in lon_cells:
+                    keys.extend(self._cells.get((i, j), ()))
+        else:
+            # Otherwise, go through the non-empty cells.
+            lon_cells = set(lon_cells) if lon_cells is not None else None
+            for (i, j), cell in self._cells.iteritems():
+                if (lat_first <= i <= lat_last and (lon_cells is None or j in lon_cells)):
+                    keys.extend(cell)
+        if len(keys) == 0:
+            return list()
+        dists = distance_many(point, [self._points[k].lat for k in keys],
+                [self._points[k].lon for k in keys])
+        order = np.argsort(dists, kind='mergesort')
+        return [(keys[i], dists[i]) for i in order if dists[i] <= radius]
+
+    def nearest(self, point, k):
+        """Find the `k` points that are nearest to the given one.
+
+        Returns a list of (key, distance) pairs, nearest first. The search
+        radius is doubled until enough points are found: all the points
+        within the radius are exact results.
+        """
+        k = min(k, len(self._points))
+        if k <= 0:
+            return list()
+        radius = deg_to_rad(self._cell_size) * EARTH_RADIUS
+        while True:
+            res = self.within(point, radius)
+            if len(res) >= k or radius > pi * EARTH_RADIUS:
+                return res[:k]
+            radius *= 2
+
+    def _cell(self, lat, lon):
+        return (int(floor(lat / self._cell_size)),
+                int(floor((lon + 180) / self._cell_size)) % self._nb_lon_cells)
+
+
 def deg_to_rad(angle):
     """Convert an angle from degree to radians."""
     return (2 * pi / 360) * angle
@@ -111,32 +248,56 @@ def map_location_on_grid(point):
     # return Point(lat, lon)
     
     #new implementation:
-    lat = point.lat;
-    lon = point.lon;
+    row, col = grid_cell(point)
+    clusterLat = row * (clusterHeight / EARTH_RADIUS)
+
+    if cos(clusterLat) == 0:
+        clusterLat = clusterLat + 0.0001
+
+    clusterLon = col * clusterWidth / (EARTH_RADIUS * cos(clusterLat))
+
+    return Point(rad_to_deg(clusterLat), rad_to_deg(clusterLon))
+
+
+def grid_cell(point):
+    """Get the (row, column) of the grid cell of a point.
+
+    The cell's position is given by map_location_on_grid.
+    """
+    phi = deg_to_rad(point.lat)
+    theta = deg_to_rad(point.lon)
 
-    phi = deg_to_rad(lat)
-    theta = deg_to_rad(lon)
-    
     #The distance between two latitudes changes only a little bit depending
     #on where we are on the map, so we consider it as a constant.
     clusterVertAngle = clusterHeight / EARTH_RADIUS
-    
+
     # Here we find the position of the nearest cluster.
     # phi/clusterVertAngle is the rational number of clusters that we need to cross in order to reach the user.
     # The mapping operation consists of taking the floor of that number, it maps the user to the nearest cluster on his/her
     # bottom left.
-    clusterLat = floor(phi / clusterVertAngle) * clusterVertAngle
-    
+    row = int(floor(phi / clusterVertAngle))
+
     if cos(phi) == 0:
         phi = phi + 0.0001
-        
-    if cos(clusterLat) == 0:
-        clusterLat = clusterLat + 0.0001
 
     #This formula was derived from the need to adapt the amount of degrees needed to travel a distance of clusterWidth
-    #meters along a specific latitude. The circonference of a given latitude gets smaller when you go in direction of a pole. 
-    clusterLon = floor(theta / (clusterWidth / (EARTH_RADIUS * cos(phi)))) * clusterWidth / (EARTH_RADIUS * cos(clusterLat))
+    #meters along a specific latitude. The circonference of a given latitude gets smaller when you go in direction of a pole.
+    col = int(floor(theta / (clusterWidth / (EARTH_RADIUS * cos(phi)))))
+    return row, col
 
-    return Point(rad_to_deg(clusterLat), rad_to_deg(clusterLon))
-    
 
+# Bounds of the rows and columns of the grid (in absolute value).
+MAX_GRID_ROW = int(ceil(pi / 2 * EARTH_RADIUS / clusterHeight)) + 1
+MAX_GRID_COL = int(ceil(pi * EARTH_RADIUS / clusterWidth)) + 1
+
+
+def cell_id(point):
+    """Get the ID of the grid cell of a point.
+
+    The ID is a (stable) non-negative integer that identifies the cell, i.e.
+    two points have the same ID if and only if they are mapped to the same
+    position by map_location_on_grid.
+    """
+    row, col = grid_cell(point)
+    return ((row + MAX_GRID_ROW) * (2 * MAX_GRID_COL + 1)
+            + (col + MAX_GRID_COL))
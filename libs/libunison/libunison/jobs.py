@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+"""Background (re)training of the users' models.
+
+Fitting a model takes a while, so library changes only enqueue a training job
+for the user, and the jobs are processed by background workers (see
+trainer/trainer.py). Jobs are coalesced: a user has at most one pending job,
+so repeated library uploads lead to a single fit. Until the new model is
+committed, the previous one is served.
+
+A job carries the number of library entries that changed (the delta), summed
+over the coalesced jobs. Small deltas only refine the current model (see
+predict.Model.update). A delta of None means that the changes are unknown,
+and always leads to a full model selection.
+
+Workers claim a job while they process it, so a user's model is never
+trained by two workers at once. A job is only deleted once the new model is
+committed: if the training fails (or the worker dies), the job is processed
+again later. If the user is enqueued again while the job runs, the job is
+kept, and processed again once the running one is done.
+
+Failed jobs are retried with an exponential backoff (see retry_delay). After
+MAX_ATTEMPTS failures, the job is parked: it stays in the queue but isn't
+processed anymore, so that it doesn't starve the other users. Enqueuing the
+user again resets the number of attempts.
+
+Three queues are available, selected by the `training` section of the config:
+- `database` (default): a table of the main database, see schema.sql.
+- `sqlite`: a SQLite database at `training.path`, shared by the processes of a
+  single machine.
+- `local`: an in-process queue, processed by worker threads of the process.
+  Convenient for development and testing.
+"""
+
+import collections
+import logging
+import predict
+import sqlite3
+import threading
+import time
+import utils
+
+from models import User
+
+
+POLL_INTERVAL = 1.0  # Time to wait (in seconds) when the queue is empty.
+# Time (in seconds) after which a claimed job is considered abandoned (e.g.
+# the worker was killed), and can be claimed again.
+CLAIM_TIMEOUT = 60 * 60
+# Number of times a job is tried before it is parked.
+MAX_ATTEMPTS = 5
+# Time (in seconds) before a failed job is tried again, doubled after each
+# failure up to MAX_RETRY_DELAY.
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 60 * 60
+
+# Insert a job, or add the delta to the pending job of the user (NULL + x is
+# NULL, as expected). The sequence number tells whether a job was enqueued
+# again while it was running.
+QUERY_DB_PUSH = """INSERT INTO model_job (user_id, delta) VALUES (?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET
+      delta = model_job.delta + EXCLUDED.delta, seq = model_job.seq + 1,
+      attempts = 0"""
+# Claim the oldest job that is due and isn't running. Concurrent workers skip
+# each other's jobs.
+QUERY_DB_POP = """UPDATE model_job SET started = now() WHERE user_id = (
+      SELECT user_id FROM model_job
+      WHERE queued <= now() AND attempts < %d
+        AND (started IS NULL OR started < now() - interval '%d seconds')
+      ORDER BY queued LIMIT 1 FOR UPDATE SKIP LOCKED)
+    RETURNING user_id, delta, seq""" % (MAX_ATTEMPTS, CLAIM_TIMEOUT)
+# Delete a job that was processed, unless it was enqueued again meanwhile (it
+# is then released).
+QUERY_DB_DONE = """WITH deleted AS (
+      DELETE FROM model_job WHERE user_id = ? AND seq = ? RETURNING user_id)
+    UPDATE model_job SET started = NULL
+    WHERE user_id = ? AND NOT EXISTS (SELECT 1 FROM deleted)"""
+# Release a job that failed, it is due again after the backoff.
+QUERY_DB_RETRY = """UPDATE model_job SET started = NULL,
+      queued = now() + least(%d * 2 ^ attempts, %d) * interval '1 second',
+      attempts = attempts + 1
+    WHERE user_id = ? RETURNING attempts""" % (RETRY_DELAY, MAX_RETRY_DELAY)
+
+QUERY_SQLITE_CREATE = """CREATE TABLE IF NOT EXISTS model_job (
+    user_id INTEGER PRIMARY KEY,
+    queued  REAL NOT NULL,
+    delta   INTEGER,
+    started REAL,
+    seq     INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0)"""
+QUERY_SQLITE_UPDATE = """UPDATE model_job
+    SET delta = delta + ?, seq = seq + 1, attempts = 0 WHERE user_id = ?"""
+QUERY_SQLITE_INSERT = """INSERT INTO model_job (user_id, queued, delta)
+    VALUES (?, ?, ?)"""
+QUERY_SQLITE_FIRST = """SELECT user_id, delta, seq FROM model_job
+    WHERE queued <= ? AND attempts < %d AND (started IS NULL OR started < ?)
+    ORDER BY queued LIMIT 1""" % MAX_ATTEMPTS
+QUERY_SQLITE_CLAIM = "UPDATE model_job SET started = ? WHERE user_id = ?"
+QUERY_SQLITE_DELETE = "DELETE FROM model_job WHERE user_id = ? AND seq = ?"
+QUERY_SQLITE_UNCLAIM = "UPDATE model_job SET started = NULL WHERE user_id = ?"
+QUERY_SQLITE_RELEASE = """UPDATE model_job SET started = NULL,
+      queued = ? + min(%d * (1 << attempts), %d), attempts = attempts + 1
+    WHERE user_id = ?""" % (RETRY_DELAY, MAX_RETRY_DELAY)
+QUERY_SQLITE_ATTEMPTS = "SELECT attempts FROM model_job WHERE user_id = ?"
+# Columns added since the first version of the queue.
+QUERY_SQLITE_MIGRATE = [
+  ('started', "ALTER TABLE model_job ADD COLUMN started REAL"),
+  ('seq', "ALTER TABLE model_job ADD COLUMN seq INTEGER NOT NULL DEFAULT 0"),
+  ('attempts',
+      "ALTER TABLE model_job ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0"),
+]
+
+
+def retry_delay(attempts):
+    """Get the time (in seconds) to wait before trying a job again, given the
+    number of times it failed."""
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+class DatabaseQueue(object):
+    """Job queue stored in the main database.
+
+    Pushing a job is part of the store's current transaction.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._claimed = dict()  # User ID => sequence number of the job.
+
+    def push(self, uid, delta=None):
+        self._store.execute(QUERY_DB_PUSH, (uid, delta))
+
+    def pop(self):
+        """Claim the oldest job and return its (user ID, delta), or None."""
+        res = self._store.execute(QUERY_DB_POP).get_one()
+        self._store.commit()
+        if res is None:
+            return None
+        uid, delta, seq = res
+        self._claimed[uid] = seq
+        return uid, delta
+
+    def done(self, uid):
+        """Delete a claimed job, once it was processed."""
+        seq = self._claimed.pop(uid)
+        self._store.execute(QUERY_DB_DONE, (uid, seq, uid))
+        self._store.commit()
+
+    def retry(self, uid):
+        """Release a claimed job that failed, so that it is processed again
+        later. Returns False if the job was parked instead."""
+        self._claimed.pop(uid, None)
+        res = self._store.execute(QUERY_DB_RETRY, (uid,)).get_one()
+        self._store.commit()
+        return res is not None and res[0] < MAX_ATTEMPTS
+
+
+class SQLiteQueue(object):
+    """Job queue stored in a SQLite database."""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, isolation_level=None,
+                check_same_thread=False)
+        self._conn.execute(QUERY_SQLITE_CREATE)
+        columns = [row[1] for row
+                in self._conn.execute("PRAGMA table_info(model_job)")]
+        for column, query in QUERY_SQLITE_MIGRATE:
+            if column not in columns:
+                # Queue created by an older version.
+                self._conn.execute(query)
+        self._lock = threading.Lock()
+        self._claimed = dict()  # User ID => sequence number of the job.
+
+    def push(self, uid, delta=None):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self._conn.execute(QUERY_SQLITE_UPDATE, (delta, uid))
+                if cursor.rowcount == 0:
+                    self._conn.execute(QUERY_SQLITE_INSERT,
+                            (uid, time.time(), delta))
+            finally:
+                self._conn.execute("COMMIT")
+
+    def pop(self):
+        """Claim the oldest job and return its (user ID, delta), or None."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                res = self._conn.execute(QUERY_SQLITE_FIRST,
+                        (now, now - CLAIM_TIMEOUT)).fetchone()
+                if res is not None:
+                    self._conn.execute(QUERY_SQLITE_CLAIM, (now, res[0]))
+            finally:
+                self._conn.execute("COMMIT")
+            if res is None:
+                return None
+            uid, delta, seq = res
+            self._claimed[uid] = seq
+        return uid, delta
+
+    def done(self, uid):
+        """Delete a claimed job, once it was processed."""
+        with self._lock:
+            seq = self._claimed.pop(uid)
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self._conn.execute(QUERY_SQLITE_DELETE, (uid, seq))
+                if cursor.rowcount == 0:
+                    # Enqueued again while it was running.
+                    self._conn.execute(QUERY_SQLITE_UNCLAIM, (uid,))
+            finally:
+                self._conn.execute("COMMIT")
+
+    def retry(self, uid):
+        """Release a claimed job that failed, so that it is processed again
+        later. Returns False if the job was parked instead."""
+        with self._lock:
+            self._claimed.pop(uid, None)
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(QUERY_SQLITE_RELEASE, (time.time(), uid))
+                res = self._conn.execute(QUERY_SQLITE_ATTEMPTS,
+                        (uid,)).fetchone()
+            finally:
+                self._conn.execute("COMMIT")
+        return res is not None and res[0] < MAX_ATTEMPTS
+
+
+class LocalQueue(object):
+    """In-process job queue."""
+
+    def __init__(self):
+        self._jobs = collections.OrderedDict()
+        self._running = dict()  # User ID => delta of the running job.
+        self._again = dict()  # Jobs enqueued again while they run.
+        self._attempts = dict()  # User ID => number of failures.
+        self._due = dict()  # User ID => time when a failed job is due.
+        self._parked = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _add(jobs, uid, delta):
+        if uid not in jobs:
+            jobs[uid] = delta
+        elif jobs[uid] is not None and delta is not None:
+            jobs[uid] += delta
+        else:
+            jobs[uid] = None
+
+    def push(self, uid, delta=None):
+        with self._lock:
+            self._attempts.pop(uid, None)
+            if uid in self._parked:
+                self._add(self._jobs, uid, self._parked.pop(uid))
+            if uid in self._running:
+                self._add(self._again, uid, delta)
+            else:
+                self._add(self._jobs, uid, delta)
+
+    def pop(self):
+        """Claim the oldest job and return its (user ID, delta), or None."""
+        now = time.time()
+        with self._lock:
+            for uid in self._jobs:
+                if self._due.get(uid, 0) <= now:
+                    break
+            else:
+                return None
+            delta = self._jobs.pop(uid)
+            self._due.pop(uid, None)
+            self._running[uid] = delta
+            return uid, delta
+
+    def done(self, uid):
+        """Forget a claimed job, once it was processed."""
+        with self._lock:
+            del self._running[uid]
+            self._attempts.pop(uid, None)
+            if uid in self._again:
+                self._add(self._jobs, uid, self._again.pop(uid))
+
+    def retry(self, uid):
+        """Enqueue a claimed job that failed again, after a delay. Returns
+        False if the job was parked instead."""
+        with self._lock:
+            delta = self._running.pop(uid)
+            if uid in self._again:
+                self._add(self._jobs, uid, self._again.pop(uid))
+            attempts = self._attempts.get(uid, 0) + 1
+            if attempts >= MAX_ATTEMPTS:
+                self._attempts.pop(uid, None)
+                self._add(self._parked, uid, delta)
+                if uid in self._jobs:
+                    self._add(self._parked, uid, self._jobs.pop(uid))
+                return False
+            self._attempts[uid] = attempts
+            self._due[uid] = time.time() + retry_delay(attempts)
+            self._add(self._jobs, uid, delta)
+            return True
+
+    def __len__(self):
+        return len(self._jobs)
+
+
+def train(store, uid, delta=None, pool=None, batch=None):
+    """Update (see predict.Model.update) and commit the model of a user.
+
+    Candidate models are fitted in parallel if a pool of processes is given,
+    `batch` at a time (typically, the number of processes of the pool).
+    Returns the model, or None if the user doesn't exist.
+    """
+    user = store.get(User, uid)
+    if user is None:
+        return None
+    model = predict.Model(user)
+    model.update(store, delta, pool=pool, batch=batch)
+    store.commit()
+    return model
+
+
+class Worker(threading.Thread):
+    """Process the training jobs of a queue, one at a time."""
+
+    def __init__(self, queue, store, logger=None, interval=POLL_INTERVAL,
+            pool=None, batch=None):
+        self._queue = queue
+        self._store = store
+        self._pool = pool
+        self._batch = batch
+        self._logger = logger or logging.getLogger(__name__)
+        self._interval = interval
+        self._stopped = threading.Event()
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def run(self):
+        while not self._stopped.is_set():
+            if not self.process_one():
+                self._stopped.wait(self._interval)
+
+    def process_one(self):
+        """Process a job, if there is one. Returns False if the queue was
+        empty."""
+        job = self._queue.pop()
+        if job is None:
+            return False
+        uid, delta = job
+        start = time.time()
+        try:
+            model = train(self._store, uid, delta, self._pool, self._batch)
+        except Exception:
+            self._store.rollback()
+            self._logger.exception("couldn't train the model of user %d"
+                    % uid)
+            if not self._queue.retry(uid):
+                self._logger.error("giving up on the model of user %d after"
+                        " %d attempts" % (uid, MAX_ATTEMPTS))
+            return True
+        # The model is committed, the job can go.
+        self._queue.done(uid)
+        if model is None:
+            self._logger.warn("user %d doesn't exist" % uid)
+            return True
+        fits = ", ".join("k=%d: %.2fs" % (k, secs)
+                for k, bic, secs in model.fit_times)
+        self._logger.info("trained model of user %d (delta: %r): %d"
+                " components (%.2fs; %s)" % (uid, delta,
+                model.get_nb_components(), time.time() - start,
+                fits or ("refined" if model.is_nontrivial() else "none")))
+        return True
+
+    def stop(self):
+        self._stopped.set()
+
+
+_local = dict()
+_local_lock = threading.Lock()
+
+
+def _local_queue(config):
+    """Get the local queue of the process, and start its workers."""
+    with _local_lock:
+        if 'queue' not in _local:
+            queue = LocalQueue()
+            nb_workers = config.get('training', {}).get('workers', 1)
+            for i in xrange(nb_workers):
+                store = utils.get_store(config['database']['string'])
+                Worker(queue, store).start()
+            _local['queue'] = queue
+        return _local['queue']
+
+
+@utils.memo
+def _sqlite_queue(path):
+    return SQLiteQueue(path)
+
+
+def get_queue(config, store=None):
+    """Get the job queue selected by the config.
+
+    The store is used by the database queue (the default).
+    """
+    options = config.get('training', {})
+    kind = options.get('queue', 'database')
+    if kind == 'database':
+        return DatabaseQueue(store)
+    elif kind == 'sqlite':
+        return _sqlite_queue(options['path'])
+    elif kind == 'local':
+        return _local_queue(config)
+    raise ValueError("unknown queue: %r" % kind)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""Request lifecycle shared by the Flask apps (API and website).
+
+The configuration file is read once per process, and only read again when it
+is modified. Database connections are reused across requests: each request
+borrows a Storm store from a bounded pool, and gives it back at the end.
+"""
+
+import os
+import storm.locals
+import threading
+import time
+import yaml
+
+
+POOL_SIZE = 10  # Maximal number of stores per process.
+POOL_TIMEOUT = 30.0  # Maximal time (in seconds) to wait for a free store.
+
+
+class Config(object):
+    """Configuration file, reloaded when its modification time changes."""
+
+    def __init__(self, path):
+        self._path = path
+        self._mtime = None
+        self._data = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        mtime = os.path.getmtime(self._path)
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    with open(self._path) as stream:
+                        self._data = yaml.load(stream)
+                    self._mtime = mtime
+        return self._data
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class StorePool(object):
+    """Bounded pool of Storm stores.
+
+    Stores are rolled back when they are released, so that a store never
+    carries a transaction or cached objects over to the next request.
+    """
+
+    def __init__(self, conn_str, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self._database = storm.locals.create_database(conn_str)
+        self._size = size
+        self._timeout = timeout
+        self._idle = list()
+        self._count = 0  # Number of stores, idle or not.
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Get a store, waiting if they are all in use."""
+        deadline = time.time() + self._timeout
+        with self._cond:
+            while len(self._idle) == 0 and self._count >= self._size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolExhausted("no store available")
+                self._cond.wait(remaining)
+            if len(self._idle) > 0:
+                return self._idle.pop()
+            self._count += 1
+        try:
+            return storm.locals.Store(self._database)
+        except:
+            self._discard()
+            raise
+
+    def release(self, store):
+        """Give a store back to the pool.
+
+        The store is rolled back. If that fails (e.g. the connection was
+        lost), it is closed instead of being reused.
+        """
+        try:
+            store.rollback()
+            store.invalidate()
+        except Exception:
+            store.close()
+            self._discard()
+        else:
+            with self._cond:
+                self._idle.append(store)
+                self._cond.notify()
+
+    def _discard(self):
+        with self._cond:
+            self._count -= 1
+            self._cond.notify()
+
+
+_configs = dict()
+_pools = dict()
+_lock = threading.Lock()
+
+
+def get_config(path):
+    """Get the configuration at the given path (see Config)."""
+    with _lock:
+        if path not in _configs:
+            _configs[path] = Config(path)
+        config = _configs[path]
+    return config.get()
+
+
+def get_pool(conn_str, size=POOL_SIZE):
+    """Get the pool of stores of a database (one per process)."""
+    with _lock:
+        if conn_str not in _pools:
+            _pools[conn_str] = StorePool(conn_str, size)
+        return _pools[conn_str]
+
+
+def init_app(app):
+    """Set up the request lifecycle of a Flask app.
+
+    Before each request, `g.config` is set to the configuration, and
+    `g.store` to a store borrowed from the pool. The store is committed after
+    the request, and released in any case (even if the request failed).
+    """
+    # Imported here, libunison doesn't depend on Flask otherwise.
+    from flask import g, request
+
+    @app.before_request
+    def setup_request():
+        g.config = get_config(
+                '%s/config.yaml' % request.environ['UNISON_ROOT'])
+        options = g.config['database']
+        g.pool = get_pool(options['string'], options.get('pool', POOL_SIZE))
+        g.store = g.pool.acquire()
+
+    @app.after_request
+    def commit_request(response):
+        g.store.commit()
+        return response
+
+    @app.teardown_request
+    def teardown_request(exception):
+        store = getattr(g, 'store', None)
+        if store is not None:
+            g.pool.release(store)
+            g.store = None
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 from storm.locals import *
-from _storm_ext import Point
+from _storm_ext import Point, Features
 
 
 class User(Storm):
@@ -48,6 +48,8 @@ class Group(Storm):
     password = Unicode()
     updated = DateTime(name='update_time')
     is_automatic = Bool(name='automatic')
+    # Incremented whenever the members or the master change.
+    state_version = Int()
 
     # Relationships
     master = Reference(master_id, 'User.id')
@@ -91,7 +93,7 @@ class Track(Storm):
     image = Unicode()
     listeners = Int()
     tags = Unicode()
-    features = Unicode()
+    features = Features()
     # Relationships
     lib_entries = ReferenceSet(id, 'LibEntry.track_id')
 
@@ -137,9 +139,12 @@ class GroupEvent(Storm):
       u'master': u'master',
     })
     payload = JSON()
+    # Track of play, skip and rating events.
+    track_id = Int()
     # Relationships
     user = Reference(user_id, 'User.id')
     group = Reference(group_id, 'Group.id')
+    track = Reference(track_id, 'Track.id')
 
     def __init__(self, group, user, event_type, payload=None):
         self.group = group
@@ -151,13 +156,15 @@ class Cluster(Storm):
     __storm_table__ = 'cluster'
     id = Int(primary=True)
     coordinates = Point(name='position')
+    cell_id = Int()
     group_id = Int()
     # Relationships
     group = Reference(group_id, 'Group.id')
     users = ReferenceSet(id, 'User.cluster_id')
 
-    def __init__(self, coordinates = None):
+    def __init__(self, coordinates = None, cell_id = None):
         self.coordinates = coordinates
+        self.cell_id = cell_id
 
         
 class Playlist(Storm):
@@ -173,7 +180,7 @@ class Playlist(Storm):
     size = Int()
     seeds = JSON()
     options = JSON()
-    features = Unicode()
+    features = Features()
     avg_rating = Float()
     is_valid = Bool(name='valid')
     is_shared = Bool(name='shared')
@@ -227,7 +234,7 @@ class TopTag(Storm):
     ref_id = Int()
     count = Int()
     url = Unicode()
-    features = Unicode()
+    features = Features()
     
     def __init__(self, name, ref_id, features, count=None, url=None):
         self.name = name
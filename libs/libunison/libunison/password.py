@@ -1,35 +1,72 @@
 #!/usr/bin/env python
-"""Password hashing based on PBKDF2."""
+"""Password hashing based on PBKDF2.
+
+Hashes look like `pbkdf2_sha256$<iterations>$<salt>$<digest>`, where the salt
+and the digest are base64-encoded. They are computed with hashlib's (C)
+implementation of PBKDF2. Hashes of older versions (`<salt>:<digest>`, with
+1000 iterations) can still be verified, but should be replaced as soon as
+possible (see needs_rehash).
+"""
 
 import base64
 import hashlib
+import hmac
 import os
 
-from pbkdf2 import PBKDF2
+
+ALGORITHM = 'pbkdf2_sha256'
+NB_ITERATIONS = 20000
+SALT_LENGTH = 16  # In bytes.
+HASH_LENGTH = 32  # In bytes.
+HASH_FUNCTION = 'sha256'
+
+# Parameters of the legacy `<salt>:<digest>` hashes.
+LEGACY_ITERATIONS = 1000
+LEGACY_HASH_LENGTH = 16
 
 
-NB_ITERATIONS = 1000
-HASH_LENGTH = 16  # In bytes.
-HASH_FUNCTION = hashlib.sha256
+def _pbkdf2(password, salt, iterations, length):
+    return hashlib.pbkdf2_hmac(HASH_FUNCTION, password.encode('utf-8'), salt,
+            iterations, length)
 
 
-def encrypt(password, key=None):
+def encrypt(password, salt=None, iterations=NB_ITERATIONS):
     # Password must be Unicode.
     assert isinstance(password, unicode)
-    if key is None:
-        key = os.urandom(HASH_LENGTH)
-    mac = PBKDF2(password.decode('utf-8'), key, iterations=NB_ITERATIONS,
-            digestmodule=HASH_FUNCTION).read(HASH_LENGTH)
-    return u":".join([
-      base64.b64encode(key),
-      base64.b64encode(mac)
+    if salt is None:
+        salt = os.urandom(SALT_LENGTH)
+    digest = _pbkdf2(password, salt, iterations, HASH_LENGTH)
+    return u"$".join([
+      ALGORITHM,
+      unicode(iterations),
+      base64.b64encode(salt),
+      base64.b64encode(digest),
     ])
 
 
 def verify(password, encrypted):
-   key, mac = encrypted.split(':')
-   raw_key = base64.b64decode(key)
-   return encrypted == encrypt(password, key=raw_key)
+    if encrypted.startswith(ALGORITHM + '$'):
+        algorithm, iterations, salt, digest = encrypted.split('$')
+        digest = base64.b64decode(digest)
+        mac = _pbkdf2(password, base64.b64decode(salt), int(iterations),
+                len(digest))
+    else:
+        salt, digest = encrypted.split(':')
+        digest = base64.b64decode(digest)
+        mac = _pbkdf2(password, base64.b64decode(salt), LEGACY_ITERATIONS,
+                LEGACY_HASH_LENGTH)
+    return hmac.compare_digest(mac, digest)
+
+
+def needs_rehash(encrypted):
+    """Tell whether a hash is outdated (old format, or too few iterations).
+
+    Outdated hashes should be replaced by a new one, e.g. after the next
+    successful login.
+    """
+    if not encrypted.startswith(ALGORITHM + '$'):
+        return True
+    return int(encrypted.split('$')[1]) < NB_ITERATIONS
 
 
 def is_good_enough(password):
@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 
+import collections
 import numpy as np
 import sklearn.mixture
 import utils
 import math
 import pickle
-
-from numpy.linalg import eig
+import scipy.linalg
+import scipy.sparse
+import struct
+import time
 
 from operator import itemgetter, mul
 from models import *
+from scipy.sparse.csgraph import connected_components
 
 
 DIMENSIONS = 5
@@ -17,57 +21,381 @@ SCALE = 5
 
 
 class Model(object):
+    """Gaussian mixture model of a user's library.
+
+    Models are stored in `user.model` in a compact format (see encode_model),
+    and deserialized models are kept in a per-process cache keyed by the user
+    and the version of the model.
+    """
 
     K_MAX = 10
     MIN_COVAR = 0.001
+    PATIENCE = 2  # Stop after that many consecutive increases of the BIC.
+    # Library changes up to this fraction of the library only refine the
+    # current model (see update).
+    UPDATE_FRACTION = 0.1
+    UPDATE_ITER = 10  # Number of EM iterations when refining.
+    # Refit from scratch if the mean log-likelihood of the library drops
+    # by more than that since the last model selection.
+    UPDATE_TOLERANCE = 0.25
 
     def __init__(self, user):
         self._user = user
-        if user.model is not None:
-            self._gmm = pickle.loads(user.model.encode('utf-8'))
-        else:
-            self._gmm = None
+        self._params = get_params(user)
+        # (k, BIC, seconds) for each candidate fitted by generate.
+        self.fit_times = list()
 
-    def generate(self, store):
-        points = get_points(self._user, store)
-        k_max = min(self.K_MAX, len(points) / (2 * DIMENSIONS))
-        if k_max < 1:
+    def generate(self, store, pool=None, batch=None, patience=None,
+            points=None):
+        """Fit the model to the user's library (see fit_model).
+
+        If a pool of processes is given, `batch` candidates (typically, the
+        number of processes in the pool) are fitted at the same time.
+        """
+        if points is None:
+            points = get_points(self._user, store)
+        params, self.fit_times = select_model(points, prev=self._params,
+                pool=pool, batch=batch or 1,
+                patience=self.PATIENCE if patience is None else patience)
+        if params is None:
             self._user.model = None
-            self._gmm = None
+            self._params = None
             return
-        candidates = list()
-        for k in range(1, k_max+1):
-            gmm = sklearn.mixture.GMM(n_components=k, covariance_type='full',
-                    min_covar=self.MIN_COVAR)
-            gmm.fit(points)
-            candidates.append((gmm, gmm.bic(points)))
-        self._gmm, bic = min(candidates, key=itemgetter(1))
-        self._user.model = unicode(pickle.dumps(self._gmm))
+        self._save(store, params)
+
+    def update(self, store, delta=None, pool=None, batch=None):
+        """Update the model after `delta` library entries changed.
+
+        When few entries changed (at most UPDATE_FRACTION of the library),
+        the current model is only refined by a few EM iterations. We fall back
+        to a full model selection (see generate) if the library isn't as well
+        explained as at the last selection, or if delta is None (unknown).
+        Returns True if the model was only refined.
+        """
+        points = get_points(self._user, store)
+        if (delta is not None and self.is_nontrivial()
+                and self._params.loglik is not None
+                and delta <= self.UPDATE_FRACTION * len(points)
+                and self.get_nb_components() * 2 * DIMENSIONS <= len(points)):
+            params = refine_model(self._params, points, self.UPDATE_ITER,
+                    self.MIN_COVAR)
+            loglik = mean_loglik(params, points)
+            if loglik >= self._params.loglik - self.UPDATE_TOLERANCE:
+                # Keep the reference of the last selection, so that the
+                # drift doesn't accumulate unnoticed.
+                self.fit_times = list()
+                self._save(store, params._replace(loglik=self._params.loglik))
+                return True
+        self.generate(store, pool=pool, batch=batch, points=points)
+        return False
+
+    def _save(self, store, params):
+        self._params = params
+        version = next_version(self._user.model)
+        self._user.model = encode_model(params, version)
+        _model_cache.put((self._user.id, version), params)
         store.flush()
 
     def is_nontrivial(self):
-        return self._gmm is not None
+        return self._params is not None
 
     def get_nb_components(self):
         if not self.is_nontrivial():
             return 0
-        return self._gmm.n_components
+        return len(self._params.weights)
 
     def score(self, points):
         if not self.is_nontrivial():
             return None
-        return [math.exp(x) for x in self._gmm.score(points)]
+        return np.exp(score_many([self], points)[0])
+
+
+# Parameters of a Gaussian mixture. The covariance matrix of component i is
+# `np.dot(chols[i], chols[i].T)` (chols are lower-triangular). `loglik` is the
+# mean log-likelihood of the library when the model was selected (or None).
+# The other fields are derived from these, see make_params.
+ModelParams = collections.namedtuple('ModelParams',
+        'weights means chols precs consts loglik')
+
+MODEL_FORMAT = 'gmm2'
+MODEL_FORMAT_V1 = 'gmm1'  # Same, without the log-likelihood.
+MODEL_DTYPE = np.dtype('>f4')
+MODEL_CACHE_SIZE = 1000  # Number of deserialized models kept in memory.
+
+_model_cache = utils.LRUCache(MODEL_CACHE_SIZE)
+
+
+def make_params(weights, means, chols, loglik=None):
+    """Build the parameters of a Gaussian mixture.
+
+    Precomputes what is needed to evaluate the log-density of component i at
+    x, which is `consts[i] - 0.5 * |dot(x - means[i], precs[i])|^2`.
+    """
+    dim = means.shape[1]
+    eye = np.eye(dim)
+    precs = np.array([scipy.linalg.solve_triangular(chol, eye, lower=True).T
+            for chol in chols]).reshape(len(chols), dim, dim)
+    consts = (np.log(weights) - 0.5 * dim * np.log(2 * np.pi)
+            - np.sum(np.log(np.diagonal(chols, axis1=1, axis2=2)), axis=1))
+    return ModelParams(weights, means, chols, precs, consts, loglik)
+
+
+def select_model(points, prev=None, pool=None, batch=1,
+        patience=Model.PATIENCE):
+    """Fit a model to a user's points (see fit_model).
+
+    Returns the parameters of the model (None if there are not enough points
+    to fit one) and the list of (k, BIC, seconds) of the candidates.
+    """
+    k_max = min(Model.K_MAX, len(points) / (2 * DIMENSIONS))
+    if k_max < 1:
+        return None, list()
+    return fit_model(points, k_max, prev=prev, pool=pool, batch=batch,
+            patience=patience, min_covar=Model.MIN_COVAR)
+
+
+def fit_model(points, k_max, prev=None, pool=None, batch=1,
+        patience=Model.PATIENCE, min_covar=Model.MIN_COVAR):
+    """Select and fit a Gaussian mixture to the points.
+
+    Mixtures with k = 1, 2, ..., k_max components are fitted, and the one
+    with the lowest BIC is kept. We stop early once the BIC has increased
+    `patience` times in a row. Candidates are fitted by batches of `batch`,
+    in parallel if a pool of processes is given. The candidate with as many
+    components as the previous model (or the closest) starts from its
+    parameters instead of from scratch.
+
+    Returns the parameters of the mixture (with the mean log-likelihood of
+    the points) and a list of (k, BIC, seconds) for the candidates that were
+    considered.
+    """
+    warm_k, warm = _warm_start(prev, k_max)
+    best, best_bic = None, None
+    prev_bic, increases = None, 0
+    fit_times = list()
+    for first in xrange(1, k_max + 1, batch):
+        tasks = [(points, k, warm if k == warm_k else None, min_covar)
+                for k in xrange(first, min(first + batch, k_max + 1))]
+        if pool is not None:
+            results = pool.map(_fit_candidate, tasks)
+        else:
+            results = map(_fit_candidate, tasks)
+        for task, (params, bic, secs) in zip(tasks, results):
+            fit_times.append((task[1], bic, secs))
+            if best is None or bic < best_bic:
+                best, best_bic = params, bic
+            if prev_bic is not None and bic > prev_bic:
+                increases += 1
+            else:
+                increases = 0
+            prev_bic = bic
+            if increases >= patience:
+                return best, fit_times
+    return best, fit_times
+
+
+def _warm_start(prev, k_max):
+    """Get the number of components and the parameters to start from."""
+    if prev is None or prev.means.shape[1] != DIMENSIONS:
+        return None, None
+    if len(prev.weights) <= k_max:
+        return len(prev.weights), prev
+    # Keep the heaviest components.
+    keep = np.argsort(-prev.weights, kind='mergesort')[:k_max]
+    weights = prev.weights[keep] / np.sum(prev.weights[keep])
+    return k_max, make_params(weights, prev.means[keep], prev.chols[keep])
+
+
+def refine_model(params, points, n_iter, min_covar=Model.MIN_COVAR):
+    """Run a few EM iterations, starting from the given parameters."""
+    gmm = _init_gmm(params, n_iter=n_iter, min_covar=min_covar)
+    gmm.fit(points)
+    return gmm_params(gmm)
+
+
+def _init_gmm(params, **kwargs):
+    """Build an sklearn GMM that starts from the given parameters."""
+    gmm = sklearn.mixture.GMM(n_components=len(params.weights),
+            covariance_type='full', init_params='', **kwargs)
+    gmm.weights_ = params.weights.copy()
+    gmm.means_ = params.means.copy()
+    gmm.covars_ = np.einsum('kij,klj->kil', params.chols, params.chols)
+    return gmm
+
+
+def mean_loglik(params, points):
+    """Compute the mean log-likelihood of the points under a mixture."""
+    return float(np.mean(log_densities([params], points)))
+
+
+def _fit_candidate(task):
+    """Fit a GMM with k components (possibly in a worker process)."""
+    points, k, init, min_covar = task
+    start = time.time()
+    if init is not None:
+        # Only refine the given parameters.
+        gmm = _init_gmm(init, min_covar=min_covar)
+    else:
+        gmm = sklearn.mixture.GMM(n_components=k, covariance_type='full',
+                min_covar=min_covar)
+    gmm.fit(points)
+    params = gmm_params(gmm, np.mean(gmm.score(points)))
+    return params, gmm.bic(points), time.time() - start
+
+
+def gmm_params(gmm, loglik=None):
+    """Get the parameters of a (full covariance) sklearn GMM."""
+    return make_params(np.array(gmm.weights_), np.array(gmm.means_),
+            np.array([np.linalg.cholesky(cov) for cov in gmm.covars_]),
+            loglik)
+
+
+def encode_model(params, version):
+    """Serialize the parameters of a Gaussian mixture.
+
+    The result looks like `gmm2:<version>:<data>`, where the data is the
+    (base64-encoded) number of components and dimensions and the mean
+    log-likelihood (NaN if unknown), followed by the weights, the means and
+    the lower triangles of the Cholesky factors as big-endian floats.
+    """
+    nb_comps, dim = params.means.shape
+    rows, cols = np.tril_indices(dim)
+    values = np.concatenate((params.weights, params.means.ravel(),
+            params.chols[:, rows, cols].ravel()))
+    loglik = params.loglik if params.loglik is not None else float('nan')
+    raw = struct.pack('!HHf', nb_comps, dim, loglik) + values.astype(
+            MODEL_DTYPE).tostring()
+    return u"%s:%d:%s" % (MODEL_FORMAT, version, utils.b64enc(raw))
+
+
+def decode_model(encoded):
+    """Deserialize a model encoded with encode_model.
+
+    Models stored by older versions (sklearn GMM pickles, or without the
+    log-likelihood) are also supported.
+    """
+    fmt = encoded.split(':', 1)[0]
+    if fmt not in (MODEL_FORMAT, MODEL_FORMAT_V1):
+        return gmm_params(pickle.loads(encoded.encode('utf-8')))
+    raw = utils.b64dec(encoded.rsplit(':', 1)[1])
+    if fmt == MODEL_FORMAT:
+        nb_comps, dim, loglik = struct.unpack('!HHf', raw[:8])
+        raw = raw[8:]
+    else:
+        (nb_comps, dim), loglik = struct.unpack('!HH', raw[:4]), None
+        raw = raw[4:]
+    if loglik is not None and math.isnan(loglik):
+        loglik = None
+    values = np.frombuffer(raw, dtype=MODEL_DTYPE).astype(np.float64)
+    weights, values = values[:nb_comps], values[nb_comps:]
+    means = values[:nb_comps * dim].reshape(nb_comps, dim)
+    rows, cols = np.tril_indices(dim)
+    chols = np.zeros((nb_comps, dim, dim))
+    chols[:, rows, cols] = values[nb_comps * dim:].reshape(nb_comps, -1)
+    return make_params(weights, means, chols, loglik)
+
+
+def model_version(encoded):
+    """Get the version of an encoded model (0 for pickled models)."""
+    if encoded is None:
+        return 0
+    parts = encoded.split(':', 2)
+    if parts[0] not in (MODEL_FORMAT, MODEL_FORMAT_V1):
+        return 0
+    return int(parts[1])
+
+
+def next_version(encoded):
+    """Get a version number for the model that replaces `encoded`.
+
+    Versions are timestamps (in milliseconds), but they always increase, even
+    if the clock goes back. As the user may not have a model in between, the
+    timestamp makes it unlikely that a version is ever reused.
+    """
+    return max(model_version(encoded) + 1, int(time.time() * 1000))
+
+
+def get_params(user):
+    """Get the (deserialized) parameters of the user's model, or None."""
+    if user.model is None:
+        return None
+    key = (user.id, model_version(user.model))
+    params = _model_cache.get(key)
+    if params is None:
+        params = decode_model(user.model)
+        _model_cache.put(key, params)
+    return params
+
+
+def score_many(models, points):
+    """Compute the log-density of the points under each (nontrivial) model.
+
+    Returns a (models x points) matrix. The components of all the models are
+    stacked, so that the points are projected on all of them with a single
+    matrix product. Results stay in log space, as the densities underflow
+    easily.
+    """
+    return log_densities([model._params for model in models], points)
+
+
+def log_densities(params, points):
+    """Same as score_many, for a list of ModelParams."""
+    points = np.asarray(points, dtype=np.float64)
+    if len(params) == 0 or len(points) == 0:
+        return np.zeros((len(params), len(points)))
+    sizes = [len(p.weights) for p in params]
+    means = np.concatenate([p.means for p in params])
+    precs = np.concatenate([p.precs for p in params])
+    consts = np.concatenate([p.consts for p in params])
+    nb_comps, dim = means.shape
+    # Column (i * dim + j) is the j-th coordinate in the basis of component i.
+    proj = np.dot(points, precs.transpose(1, 0, 2).reshape(dim, -1))
+    proj -= np.einsum('ij,ijk->ik', means, precs).ravel()
+    proj = proj.reshape(len(points), nb_comps, dim)
+    logs = consts - 0.5 * np.einsum('ijk,ijk->ij', proj, proj)
+    # Log-sum-exp over the components of each model.
+    starts = np.cumsum([0] + sizes[:-1])
+    top = np.maximum.reduceat(logs, starts, axis=1)
+    sums = np.add.reduceat(np.exp(logs - np.repeat(top, sizes, axis=1)),
+            starts, axis=1)
+    return (top + np.log(sums)).T
+
+
+# A library entry and its track, as returned by get_library.
+LibraryRow = collections.namedtuple('LibraryRow',
+        'entry_id local_id track_id artist title features rating')
+
+
+def get_library(store, user, *conditions):
+    """Get the valid, local library entries of a user, along with their
+    tracks.
+
+    Returns a list of LibraryRow. The entries and the tracks are fetched with
+    a single joined query, and no Storm object is built. Additional
+    conditions (on LibEntry and Track) can be given.
+    """
+    uid = user.id if isinstance(user, User) else user
+    rows = store.find((LibEntry.id, LibEntry.local_id, Track.id, Track.artist,
+            Track.title, Track.features, LibEntry.rating),
+            LibEntry.user_id == uid, LibEntry.is_local, LibEntry.is_valid,
+            LibEntry.track_id == Track.id, *conditions)
+    return [LibraryRow(*row) for row in rows]
+
+
+def library_points(library):
+    """Map the tracks of a library (see get_library) to points.
+
+    Returns the rows whose track has features, and the matrix of their
+    points (in the same order).
+    """
+    rows = [row for row in library if row.features is not None]
+    return rows, to_points(utils.decode_features_many(
+            [row.features for row in rows], DIMENSIONS))
 
 
 def get_points(user, store):
-    points = list()
-    rows = store.find(LibEntry, (LibEntry.user == user)
-            & LibEntry.is_local & LibEntry.is_valid)
-    for row in rows:
-        point = get_point(row.track)
-        if point is not None:
-            points.append(point)
-    return np.array(points)
+    rows, points = library_points(get_library(store, user))
+    return points
 
 
 def get_point(track):
@@ -77,6 +405,12 @@ def get_point(track):
     return None
 
 
+def to_points(features):
+    """Map a matrix of feature vectors (one per row) to points in the space
+    where the users' models live."""
+    return SCALE * np.asarray(features, dtype=np.float64)[:, :DIMENSIONS]
+
+
 def aggregate(ratings, mode='mult'):
     aggregate = list()
     for track_ratings in zip(*ratings):
@@ -103,37 +437,221 @@ def score_by_tag(tag_features, track_features):
 
 # calculate the transition matrix
 def transition_matrix(ranked_ratings, sorted_item_list_asc):
-    length = len(sorted_item_list_asc)
-    compdict = dict()
-    for r in ranked_ratings:
-        for i in range(0,length-1):
-            for j in range(i+1,length):
-                if (r[i]<r[j]):
-                    compdict[(r[i],r[j])] = compdict.get((r[i],r[j]),0)-1
-                else:
-                    compdict[(r[j],r[i])] = compdict.get((r[j],r[i]),0)+1
-    
-    p = np.matrix(np.zeros((length,length)))
-    for i, vali in enumerate(sorted_item_list_asc):
-        for j, valj in enumerate(sorted_item_list_asc):
-            if vali<valj:
-                if compdict[(vali,valj)]>=0:
-                    p[i,j]=1.0/length
-            elif vali>valj:
-                if compdict[(valj,vali)]<=0:
-                    p[i,j]=1.0/length
-    sub = np.ones((length,1))-p.sum(axis=1)
-    for i in range(0,length):
-        p[i,i]=sub[i,0]
+    index = dict((item, i) for i, item in enumerate(sorted_item_list_asc))
+    positions = np.empty((len(ranked_ratings), len(index)), dtype=np.int64)
+    for k, r in enumerate(ranked_ratings):
+        positions[k, [index[item] for item in r]] = np.arange(len(r))
+    return np.matrix(_transitions(majority_matrix(positions)))
+
+
+def rank_positions(ratings):
+    """Get the position of every item in every ranking.
+
+    Takes a (rankings x items) array of scores. Items are ranked by
+    decreasing score, ties are broken by order of appearance.
+    """
+    ratings = np.asarray(ratings)
+    order = np.argsort(-ratings, axis=1, kind='mergesort')
+    positions = np.empty_like(order)
+    rows = np.arange(ratings.shape[0])[:, np.newaxis]
+    positions[rows, order] = np.arange(ratings.shape[1])
+    return positions
+
+
+def majority_matrix(positions):
+    """Compute the pairwise majority preferences between items.
+
+    Entry (i, j) is True if at least as many rankings put j before i as the
+    other way around, i.e. if the MC4 chain can move from item i to item j.
+    The diagonal is False.
+    """
+    nb_items = positions.shape[1]
+    # balance[i, j] = #(j before i) - #(i before j). int16 is plenty for the
+    # number of rankings we deal with (the members of a group).
+    balance = np.zeros((nb_items, nb_items), dtype=np.int16)
+    for pos in positions:
+        balance += np.sign(pos[:, np.newaxis] - pos[np.newaxis, :]).astype(
+                np.int16)
+    moves = balance >= 0
+    np.fill_diagonal(moves, False)
+    return moves
+
+
+def _transitions(moves):
+    """Transition matrix of the MC4 chain for a majority matrix."""
+    p = moves / float(len(moves))
+    p[np.diag_indices_from(p)] = 1.0 - p.sum(axis=1)
     return p
 
 
+def mc4_iter(ratings, max_iter=10000, start=None):
+    """Aggregate rankings with the MC4 Markov chain method.
+
+    Takes a (rankings x items) array of scores and yields arrays of item
+    indices, best first. Each pass ranks the items that have a positive
+    stationary probability, then removes them from the chain.
+
+    The items with a positive probability are those of the closed class of
+    the chain. Any two items are linked in at least one direction, so the
+    classes of the chain are totally ordered, and removing the closed class
+    leaves the others unchanged. The classes are therefore computed once,
+    and each pass only solves the (small) chain restricted to one class.
+
+    The stationary distributions found so far are kept, and each pass starts
+    the solver from them (restricted to its items). `start` can give an
+    initial distribution over all the items, e.g. one of a previous
+    aggregation of similar rankings.
+    """
+    moves = majority_matrix(rank_positions(ratings))
+    if start is None:
+        dist = np.zeros(len(moves))
+    else:
+        dist = np.array(start, dtype=np.float64)
+    nb_classes, labels = connected_components(
+            scipy.sparse.csr_matrix(moves), directed=True, connection='strong')
+    # Items of a class can move to the items of all the classes above it.
+    leaving = np.sum(moves & (labels[:, np.newaxis] != labels), axis=1)
+    above = np.zeros(nb_classes, dtype=np.int64)
+    above[labels] = leaving
+    members = np.split(np.argsort(labels, kind='mergesort'),
+            np.cumsum(np.bincount(labels))[:-1])
+    alive = np.ones(len(moves), dtype=bool)
+    for label in np.argsort(above, kind='mergesort')[:max_iter]:
+        items = members[label]
+        if len(items) > 1:
+            stationary = stationary_distribution(
+                    _transitions(moves[np.ix_(items, items)]),
+                    start=dist[items])
+            dist[items] = stationary
+            # Round off the solver's noise, so that ties keep the items' order.
+            stationary = np.round(stationary, 9)
+            items = items[np.argsort(-stationary, kind='mergesort')]
+        yield items
+        alive[items] = False
+    if np.any(alive):
+        # Give up on the remaining items and keep them in their order.
+        yield np.flatnonzero(alive)
+
+
+def mc4(ratings, max_iter=10000):
+    """Aggregate rankings with MC4, see mc4_iter. Returns the full ranking.
+
+    Items with the same stationary probability (up to 1e-9) in a pass are
+    ties, and are kept in their order, i.e. by increasing index.
+    """
+    passes = list(mc4_iter(ratings, max_iter))
+    if len(passes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(passes)
+
+
+def merge_top_k(passes, ranking, k, weight, passes_weight):
+    """Select the best items of a weighted merge of two rankings.
+
+    The merged score of an item is the weighted sum of its (1-based)
+    positions in `ranking` and in the ranking given by `passes` (as yielded
+    by mc4_iter), lower is better. Returns the indices of the k best items,
+    best first (or all the items, if k is None).
+
+    Passes are consumed lazily: we stop as soon as the first k items are
+    known for sure, i.e. when they all score better than the best score any
+    item not yet ranked could get.
+    """
+    nb_items = len(ranking)
+    if k is None:
+        k = nb_items
+    positions = np.empty(nb_items)
+    positions[ranking] = np.arange(1, nb_items + 1)
+    pass_positions = np.zeros(nb_items)
+    seen = np.zeros(nb_items, dtype=bool)
+    nb_seen = 0
+    for items in passes:
+        pass_positions[items] = np.arange(nb_seen + 1, nb_seen + len(items) + 1)
+        seen[items] = True
+        nb_seen += len(items)
+        if nb_seen == nb_items:
+            break
+        if nb_seen >= k:
+            scores = (weight * positions[seen]
+                    + passes_weight * pass_positions[seen])
+            kth = np.partition(scores, k - 1)[k - 1]
+            bound = (weight * positions[~seen].min()
+                    + passes_weight * (nb_seen + 1))
+            if kth < bound:
+                break
+    candidates = np.flatnonzero(seen)
+    scores = (weight * positions[candidates]
+            + passes_weight * pass_positions[candidates])
+    k = min(k, len(candidates))
+    if k == 0:
+        return candidates
+    # Keep the items that score at least as well as the k-th one (there can
+    # be ties), sort them by score then by position in the passes.
+    best = np.flatnonzero(scores <= np.partition(scores, k - 1)[k - 1])
+    order = np.lexsort((pass_positions[candidates[best]], scores[best]))
+    return candidates[best[order[:k]]]
+
+
 # return stationary probabilities of markov chain
 def markovchain4(p):
-    S,U = eig(p.T)
-    stationary = np.array(U[:,np.where(np.abs(S-1.) < 1e-8)[0][0]].flat)
-    stationary = stationary / np.sum(stationary)
-    return [ss.real for ss in stationary]
+    return list(stationary_distribution(p))
+
+
+def stationary_distribution(p, start=None, tol=1e-10, max_iter=200):
+    """Compute the stationary distribution of a Markov chain.
+
+    Only the closed classes of the chain (the strongly connected components
+    that cannot be left) get a positive probability; they are found first,
+    and the transient states get 0. The distribution over the closed classes
+    is then computed by power iteration, starting from `start` if given
+    (e.g. the distribution found for a previous, similar chain), until the
+    L1 change is below `tol`. If it doesn't converge within `max_iter`
+    iterations (slowly mixing chains), we solve the linear system instead.
+    """
+    p = np.asarray(p, dtype=np.float64)
+    dist = np.zeros(len(p))
+    if len(p) == 0:
+        return dist
+    graph = scipy.sparse.csr_matrix(p > 0)
+    nb_classes, labels = connected_components(
+            graph, directed=True, connection='strong')
+    rows, cols = graph.nonzero()
+    is_open = np.zeros(nb_classes, dtype=bool)
+    is_open[labels[rows[labels[rows] != labels[cols]]]] = True
+    closed = np.flatnonzero(~is_open[labels])
+    q = p[np.ix_(closed, closed)]
+    # Uniformization: scale the transitions so that the chain mixes faster.
+    # This doesn't change the stationary distribution, and the self-loops
+    # (at least 1/2) keep the chain aperiodic.
+    rates = 1.0 - np.diag(q)
+    if rates.max() > 0:
+        q = q * (0.5 / rates.max())
+        q[np.diag_indices_from(q)] = 1.0 - 0.5 * rates / rates.max()
+    if start is not None and np.sum(np.asarray(start)[closed]) > 0:
+        x = np.asarray(start, dtype=np.float64)[closed]
+        x = x / np.sum(x)
+    else:
+        x = np.ones(len(closed)) / len(closed)
+    for i in xrange(max_iter):
+        y = np.dot(x, q)
+        delta = np.sum(np.abs(y - x))
+        x = y
+        if delta < tol:
+            break
+    else:
+        # Solve x (q - I) = 0, with one (redundant) equation replaced by
+        # sum(x) = 1. The system is regular if there is a single closed
+        # class, which is always the case for the MC4 chains.
+        a = q.T - np.eye(len(q))
+        a[-1] = 1.0
+        b = np.zeros(len(q))
+        b[-1] = 1.0
+        try:
+            x = np.linalg.solve(a, b)
+        except np.linalg.LinAlgError:
+            x = np.linalg.lstsq(a, b)[0]
+    dist[closed] = x / np.sum(x)
+    return dist
 
 #end @author: Hieu
 
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""Publishing of jobs to the message queue (e.g. the tag fetcher's).
+
+Each process keeps a single connection to the broker, opened on the first
+publish and reopened transparently when it is lost. The channel is in confirm
+mode: after publishing a batch, we wait (at most CONFIRM_TIMEOUT seconds)
+until the broker acknowledged all of its messages. If a message is rejected
+(nack) or not confirmed in time, the whole batch is spilled (see below), so a
+message can be delivered twice.
+
+When the broker is unreachable, messages are appended to a local spill file
+instead, and the user's request goes on. The spill file is replayed on the
+next successful publish.
+
+The broker is selected by the `queue` section of the config:
+- `amqp` (default): RabbitMQ, at `queue.host`.
+- `memory`: an in-process stand-in, which simply keeps the messages.
+  Convenient for development and testing.
+"""
+
+import json
+import logging
+import os
+import pika
+import pika.spec
+import socket
+import tempfile
+import threading
+import time
+
+
+# Time (in seconds) during which we don't try to reach a broker that is down.
+RETRY_DELAY = 5.0
+# Maximal time (in seconds) to wait for the broker to confirm a batch.
+CONFIRM_TIMEOUT = 5.0
+
+
+class BrokerError(Exception):
+    pass
+
+
+class AMQPBroker(object):
+    """Persistent connection to an AMQP broker (RabbitMQ)."""
+
+    def __init__(self, host, queue, timeout=CONFIRM_TIMEOUT):
+        self._host = host
+        self._queue = queue
+        self._timeout = timeout
+        self._conn = None
+        self._channel = None
+        self._pid = None
+        # Delivery tags of the messages not confirmed yet, and of the
+        # messages rejected by the broker.
+        self._last_tag = 0
+        self._unconfirmed = set()
+        self._rejected = set()
+
+    def publish(self, bodies):
+        """Publish messages to the queue, and wait until they are confirmed.
+
+        Reconnects (once) if the connection was lost. Raises BrokerError if
+        the messages can't be published, or if they aren't all confirmed.
+        """
+        for attempt in (1, 2):
+            try:
+                self._publish(bodies)
+                break
+            except (pika.exceptions.AMQPError, socket.error,
+                    EnvironmentError) as ex:
+                # The connection might have been closed by the broker, try
+                # again once with a new one.
+                self.close()
+                error = ex
+        else:
+            raise BrokerError("couldn't publish: %r" % error)
+        try:
+            self._wait_for_confirms()
+        except (pika.exceptions.AMQPError, socket.error,
+                EnvironmentError) as ex:
+            self.close()
+            raise BrokerError("couldn't get the confirms: %r" % ex)
+
+    def _publish(self, bodies):
+        if self._channel is None or self._pid != os.getpid():
+            # Connections can't be shared with a forked child.
+            self._connect()
+        properties = pika.BasicProperties(delivery_mode=2)
+        for body in bodies:
+            self._channel.basic_publish(exchange='', routing_key=self._queue,
+                    body=body, properties=properties)
+            # In confirm mode, messages are numbered from 1 on the channel.
+            self._last_tag += 1
+            self._unconfirmed.add(self._last_tag)
+
+    def _wait_for_confirms(self):
+        deadline = time.time() + self._timeout
+        while len(self._unconfirmed) > 0 and len(self._rejected) == 0:
+            if time.time() > deadline:
+                # We don't know what happened to the messages, start over.
+                self.close()
+                raise BrokerError("messages not confirmed by the broker")
+            self._conn.process_data_events()
+        if len(self._rejected) > 0:
+            self._unconfirmed.clear()
+            self._rejected.clear()
+            raise BrokerError("messages rejected by the broker")
+
+    def _on_confirm(self, frame):
+        """Handle an ack or a nack of the broker."""
+        method = frame.method
+        if method.multiple:
+            tags = set(t for t in self._unconfirmed if t <= method.delivery_tag)
+        else:
+            tags = set([method.delivery_tag])
+        self._unconfirmed -= tags
+        if isinstance(method, pika.spec.Basic.Nack):
+            self._rejected |= tags
+
+    def _connect(self):
+        self._conn = pika.BlockingConnection(
+                pika.ConnectionParameters(self._host))
+        self._channel = self._conn.channel()
+        # Creates the queue if it doesn't exist yet.
+        self._channel.queue_declare(queue=self._queue, durable=True)
+        self._last_tag = 0
+        self._unconfirmed.clear()
+        self._rejected.clear()
+        self._channel.confirm_delivery(self._on_confirm)
+        # confirm_delivery only registers the callback for the acks.
+        self._channel.callbacks.add(self._channel.channel_number,
+                pika.spec.Basic.Nack, self._on_confirm, False)
+        self._pid = os.getpid()
+
+    def close(self):
+        conn = self._conn
+        self._conn = None
+        self._channel = None
+        if conn is not None and self._pid == os.getpid():
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+class MemoryBroker(object):
+    """In-memory stand-in for a broker.
+
+    Published messages are appended to `messages`. Setting `is_down`
+    simulates an outage.
+    """
+
+    def __init__(self):
+        self.messages = list()
+        self.is_down = False
+
+    def publish(self, bodies):
+        if self.is_down:
+            raise BrokerError("broker is down")
+        self.messages.extend(bodies)
+
+    def close(self):
+        pass
+
+
+class Publisher(object):
+    """Publish messages to a broker, spilling them to a file when it's down.
+
+    The spill file holds one message per line, and can be shared by the
+    processes of a machine.
+    """
+
+    def __init__(self, broker, spill_path, logger=None):
+        self._broker = broker
+        self._spill_path = spill_path
+        self._logger = logger or logging.getLogger(__name__)
+        self._retry_at = 0
+        self._lock = threading.Lock()
+
+    def publish(self, bodies):
+        """Publish messages (strings without newlines).
+
+        Never fails because of the broker: if it can't be reached, the
+        messages are spilled. Returns True if the messages were sent.
+        """
+        bodies = list(bodies)
+        if len(bodies) == 0:
+            return True
+        with self._lock:
+            if time.time() < self._retry_at:
+                self._spill(bodies)
+                return False
+            try:
+                self._broker.publish(bodies)
+            except BrokerError as ex:
+                self._logger.warn("%s, spilling %d messages to %s"
+                        % (ex, len(bodies), self._spill_path))
+                self._retry_at = time.time() + RETRY_DELAY
+                self._spill(bodies)
+                return False
+            self._replay()
+            return True
+
+    def _spill(self, bodies):
+        with open(self._spill_path, 'a') as f:
+            f.write("".join("%s\n" % body for body in bodies))
+
+    def _replay(self):
+        """Publish the spilled messages, if any."""
+        if not os.path.exists(self._spill_path):
+            return
+        # Take the file over atomically, other processes might replay it.
+        path = "%s.%d" % (self._spill_path, os.getpid())
+        try:
+            os.rename(self._spill_path, path)
+        except OSError:
+            return
+        with open(path) as f:
+            bodies = [line.rstrip('\n') for line in f if line.strip()]
+        try:
+            self._broker.publish(bodies)
+        except BrokerError:
+            self._retry_at = time.time() + RETRY_DELAY
+            self._spill(bodies)
+        else:
+            self._logger.info("replayed %d spilled messages" % len(bodies))
+        os.remove(path)
+
+    def close(self):
+        with self._lock:
+            self._broker.close()
+
+
+def track_messages(pairs):
+    """Get the messages of the jobs that fetch the tags and the other
+    information of tracks, given their (artist, title) pairs."""
+    for artist, title in pairs:
+        meta = {'artist': artist, 'title': title}
+        for action in ('track-tags', 'track-info'):
+            yield json.dumps({'action': action, 'track': meta})
+
+
+_publishers = dict()
+_lock = threading.Lock()
+
+
+def get_publisher(config):
+    """Get the publisher of the process for the queue of the config."""
+    options = config['queue']
+    kind = options.get('broker', 'amqp')
+    key = (kind, options.get('host'), options['name'])
+    with _lock:
+        if key not in _publishers:
+            if kind == 'amqp':
+                broker = AMQPBroker(options['host'], options['name'])
+            elif kind == 'memory':
+                broker = MemoryBroker()
+            else:
+                raise ValueError("unknown broker: %r" % kind)
+            spill_path = options.get('spill', os.path.join(
+                    tempfile.gettempdir(), 'unison-%s.spill' % options['name']))
+            _publishers[key] = Publisher(broker, spill_path)
+        return _publishers[key]
@@ -2,14 +2,18 @@
 """Utilities for the Unison recommender system."""
 
 import base64
+import collections
 import marshal
 import math
+import numpy as np
 import os
 import os.path
 import struct
 import yaml
 import sqlite3
 import storm.locals
+import threading
+import time
 
 from functools import wraps
 from math import log, log1p
@@ -24,6 +28,9 @@ WEIGHTS_PATH = '%s/weights.marshal' % GEN_ROOT
 
 QUERY_SELECT = "SELECT vector, weight FROM tags WHERE name = ?"
 
+# Feature vectors are serialized as big-endian 4-byte floats.
+FEATURES_DTYPE = np.dtype('>f4')
+
 
 def memo(func):
     """Memoize decorator."""
@@ -36,6 +43,50 @@ def memo(func):
     return wrap
 
 
+class LRUCache(object):
+    """Thread-safe dictionary that holds at most `size` items.
+
+    When full, the least recently used item is evicted. If a time-to-live (in
+    seconds) is given, items also expire that long after they were put.
+    """
+
+    def __init__(self, size, ttl=None):
+        self._size = size
+        self._ttl = ttl
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expiry, value = self._items.pop(key)
+            except KeyError:
+                return default
+            if expiry is not None and expiry < time.time():
+                return default
+            self._items[key] = (expiry, value)
+            return value
+
+    def put(self, key, value):
+        expiry = time.time() + self._ttl if self._ttl is not None else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (expiry, value)
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
 def _load(path):
     """Read a marshalled structure from disk."""
     f = open(path, 'rb')
@@ -92,23 +143,25 @@ def tag_features(tag, conn=None, normalize=False):
         conn - a connection to a SQLite database
         tag  - the name of a tag
     and returns the feature vector associated with the tag (or None if the tag
-    wasn't found in the database).
+    wasn't found in the database). If no connection is given, the vector is
+    read from the tag space of the process (see get_tag_space).
     """
     if conn is None:
-        conn = get_feature_db()
-    res = conn.execute(QUERY_SELECT, (tag,)).fetchone()
-    if res is None:
-        return None, None
-    raw, weight = res
-    vector = list()
-    for i in xrange(0, len(raw), 4):
-        val, = struct.unpack('!f', raw[i:i+4])
-        vector.append(val)
+        vector, weight = get_tag_space().get(tag)
+        if vector is None:
+            return None, None
+    else:
+        res = conn.execute(QUERY_SELECT, (tag,)).fetchone()
+        if res is None:
+            return None, None
+        raw, weight = res
+        vector = np.frombuffer(raw, dtype=FEATURES_DTYPE)
+    vector = vector.astype(np.float64)
     if normalize:
-        norm = math.sqrt(sum([x*x for x in vector]))
+        norm = math.sqrt(np.dot(vector, vector))
         if norm > 0:
-            return tuple([x / norm for x in vector]), weight
-    return tuple(vector), weight
+            return tuple((vector / norm).tolist()), weight
+    return tuple(vector.tolist()), weight
 
 
 def track_features(tags, conn=None, tag_fct=None):
@@ -123,12 +176,13 @@ def track_features(tags, conn=None, tag_fct=None):
         def tag_fct(tag):
             return utils.tag_features(tag, conn=conn)
     """
-    if conn is None:
-        conn = get_feature_db()
     if tag_fct is None:
-        # Small closure around tag_features.
-        tag_fct = lambda tag: tag_features(tag, conn=conn)
-    vector = [0] * get_dimensions(conn)
+        if conn is None:
+            tag_fct = get_tag_space().get
+        else:
+            # Small closure around tag_features.
+            tag_fct = lambda tag: tag_features(tag, conn=conn)
+    vector = np.zeros(get_dimensions(conn))
     total = 0
     for tag, count in tags:
         if count == 0:
@@ -137,11 +191,131 @@ def track_features(tags, conn=None, tag_fct=None):
         if curr is None:
             continue
         weight = gw * log1p(float(count)) / log(2)
-        vector = [(weight*x + y) for x, y in zip(curr, vector)]
+        vector += weight * np.asarray(curr, dtype=np.float64)
         total += weight
     # Normalizing the vector would make us lose independence of features.
     # However, we should still compensate for the document's length.
-    return tuple([x / total for x in vector]) if total > 0 else None
+    return tuple((vector / total).tolist()) if total > 0 else None
+
+
+def track_features_many(tracks, space=None, normalize=False):
+    """Generate the feature vectors of many tracks at once.
+
+    Takes a list with the (tag, count) pairs of each track and returns the
+    list of their feature vectors, as track_features would (None for tracks
+    without any known tag). The tag weights of all the tracks are gathered in
+    a sparse track x tag matrix, and all the vectors are computed with a
+    single sparse-dense product. If normalize is True, the tag vectors are
+    normalized first (as with tag_features).
+    """
+    # scipy is only needed for batch featurization.
+    import scipy.sparse
+    if space is None:
+        space = get_tag_space()
+    rows, cols, counts = list(), list(), list()
+    for i, tags in enumerate(tracks):
+        for tag, count in tags:
+            if count == 0:
+                continue
+            j = space.index.get(tag)
+            if j is None:
+                continue
+            rows.append(i)
+            cols.append(j)
+            counts.append(float(count))
+    # Only keep the tags that are actually used (as columns of the matrix).
+    tag_ids, cols = np.unique(np.array(cols, dtype=np.int64),
+            return_inverse=True)
+    gws = np.asarray(space.weights, dtype=np.float64)[tag_ids][cols]
+    weights = gws * np.log1p(np.array(counts)) / log(2)
+    matrix = scipy.sparse.csr_matrix((weights, (rows, cols)),
+            shape=(len(tracks), len(tag_ids)))
+    vectors = np.asarray(space.vectors[tag_ids], dtype=np.float64)
+    if normalize:
+        norms = np.sqrt(np.sum(vectors * vectors, axis=1))
+        norms[norms == 0] = 1
+        vectors /= norms[:, np.newaxis]
+    features = np.asarray(matrix.dot(vectors))
+    totals = np.asarray(matrix.sum(axis=1)).ravel()
+    # Same length compensation as in track_features.
+    return [tuple((vector / total).tolist()) if total > 0 else None
+            for vector, total in zip(features, totals)]
+
+
+class TagSpace(object):
+    """Read-only view of the tag features database.
+
+    Maps tag names to rows of a matrix of feature vectors (and to a vector of
+    weights). When loaded from disk, the matrices are memory-mapped: they are
+    shared between all the processes that read the same files through the
+    page cache.
+    """
+
+    def __init__(self, index, vectors, weights):
+        self.index = index
+        self.vectors = vectors
+        self.weights = weights
+
+    @property
+    def dimensions(self):
+        return self.vectors.shape[1]
+
+    def get(self, tag):
+        """Get the feature vector & weight of a tag (or None, None)."""
+        row = self.index.get(tag)
+        if row is None:
+            return None, None
+        return self.vectors[row], float(self.weights[row])
+
+    def dump(self, db_path):
+        """Write the tag space next to the SQLite database."""
+        index_path, vectors_path, weights_path = tag_space_paths(db_path)
+        _dump(self.index, index_path)
+        np.save(vectors_path, np.asarray(self.vectors, dtype=np.float32))
+        np.save(weights_path, np.asarray(self.weights, dtype=np.float64))
+
+    @classmethod
+    def load(cls, db_path):
+        """Memory-map the tag space written next to the SQLite database."""
+        index_path, vectors_path, weights_path = tag_space_paths(db_path)
+        return cls(_load(index_path), np.load(vectors_path, mmap_mode='r'),
+                np.load(weights_path, mmap_mode='r'))
+
+    @classmethod
+    def from_db(cls, conn):
+        """Read the whole tag space from a SQLite database."""
+        index = dict()
+        raws = list()
+        weights = list()
+        for name, raw, weight in conn.execute(
+                "SELECT name, vector, weight FROM tags"):
+            index[name] = len(raws)
+            raws.append(str(raw))
+            weights.append(weight)
+        vectors = np.frombuffer(''.join(raws), dtype=FEATURES_DTYPE)
+        return cls(index, vectors.reshape(len(raws), -1).astype(np.float32),
+                np.array(weights, dtype=np.float64))
+
+
+def tag_space_paths(db_path):
+    """Paths of the tag space files (index, vectors, weights)."""
+    return ('%s.index' % db_path, '%s.vectors.npy' % db_path,
+            '%s.weights.npy' % db_path)
+
+
+@memo
+def get_tag_space(path=None):
+    """Get the tag space, loaded once per process.
+
+    Falls back to reading the SQLite database if the tag space hasn't been
+    generated (see lsa/gendb.py).
+    """
+    if path is None:
+        path = get_config()['tagfeats']
+    try:
+        return TagSpace.load(path)
+    except IOError:
+        return TagSpace.from_db(get_feature_db(path))
 
 
 def b64enc(raw):
@@ -156,23 +330,58 @@ def b64dec(enc):
 
 
 def encode_features(features):
-    raw = str()
-    for val in features:
-        raw += struct.pack('!f', val)
+    raw = struct.pack('!%df' % len(features), *features)
     return b64enc(raw).decode('ascii')
 
 
 def decode_features(encoded):
-    raw = b64dec(encoded)
-    features = list()
-    for i in xrange(0, len(raw), 4):
-        val, = struct.unpack('!f', raw[i:i+4])
-        features.append(val)
-    return features
+    raw = _raw_features(encoded)
+    return list(struct.unpack('!%df' % (len(raw) // 4), raw))
+
+
+def _raw_features(value):
+    """Get the raw bytes of a feature vector.
+
+    The vector is either encoded (see encode_features), or an array as read
+    from a Features property (see _storm_ext).
+    """
+    if isinstance(value, np.ndarray):
+        return value.astype(FEATURES_DTYPE).tostring()
+    return b64dec(value)
+
+
+def encode_features_many(matrix):
+    """Encode each row of a matrix of feature vectors.
+
+    Returns a list of strings, byte-for-byte identical to what
+    encode_features returns for each row taken separately.
+    """
+    matrix = np.asarray(matrix, dtype=FEATURES_DTYPE)
+    return [b64enc(row.tostring()).decode('ascii') for row in matrix]
+
+
+def decode_features_many(encoded, dim=0):
+    """Decode a list of feature vectors into a single float32 matrix.
+
+    Row i of the matrix corresponds to encoded[i], which can be either an
+    encoded string or an array (as for decode_features). All the vectors
+    must have the same number of dimensions. The dimension argument is only
+    used to shape the (empty) matrix returned when the list is empty.
+    """
+    raws = [_raw_features(enc) for enc in encoded]
+    if len(raws) == 0:
+        return np.zeros((0, dim), dtype=np.float32)
+    size = len(raws[0])
+    if any(len(raw) != size for raw in raws):
+        raise ValueError('feature vectors have different dimensions')
+    matrix = np.frombuffer(''.join(raws), dtype=FEATURES_DTYPE)
+    return matrix.reshape(len(raws), size // 4).astype(np.float32)
 
 
 @memo
-def get_dimensions(conn):
+def get_dimensions(conn=None):
+    if conn is None:
+        return get_tag_space().dimensions
     res = conn.execute("SELECT vector FROM tags LIMIT 1").fetchone()
     return len(res[0]) / 4
 
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Tests of the cache of credential checks of the API (helpers.check_password).
+"""
+
+import libunison.password as password
+import os.path
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', '..', '..', 'api', 'unison'))
+import helpers
+
+
+class FakeUser(object):
+
+    def __init__(self, email, pw):
+        self.email = email
+        self.password = password.encrypt(pw)
+
+
+class TestCheckPassword(unittest.TestCase):
+
+    def setUp(self):
+        self.nb_verify = 0
+        self._verify = password.verify
+        password.verify = self.verify
+        helpers._auth_cache.clear()
+        self.user = FakeUser(u'user@example.com', u'secret-password')
+
+    def tearDown(self):
+        password.verify = self._verify
+
+    def verify(self, pw, encrypted):
+        self.nb_verify += 1
+        return self._verify(pw, encrypted)
+
+    def test_cached(self):
+        self.assertTrue(helpers.check_password(self.user, u'secret-password'))
+        self.assertTrue(helpers.check_password(self.user, u'secret-password'))
+        self.assertEqual(self.nb_verify, 1)
+
+    def test_wrong_password(self):
+        helpers.check_password(self.user, u'secret-password')
+        for i in range(2):
+            self.assertFalse(
+                    helpers.check_password(self.user, u'secret-passwore'))
+        self.assertEqual(self.nb_verify, 3)
+
+    def test_password_changed(self):
+        helpers.check_password(self.user, u'secret-password')
+        self.user.password = password.encrypt(u'new-password')
+        self.assertFalse(helpers.check_password(self.user, u'secret-password'))
+        self.assertTrue(helpers.check_password(self.user, u'new-password'))
+
+    def test_other_user(self):
+        helpers.check_password(self.user, u'secret-password')
+        other = FakeUser(u'other@example.com', u'secret-password')
+        other.password = self.user.password
+        self.assertTrue(helpers.check_password(other, u'secret-password'))
+        self.assertEqual(self.nb_verify, 2)
+
+    def test_rehash(self):
+        self.user.password = password.encrypt(u'secret-password',
+                iterations=password.NB_ITERATIONS // 2)
+        self.assertTrue(helpers.check_password(self.user, u'secret-password'))
+        self.assertFalse(password.needs_rehash(self.user.password))
+        # The cache holds the new hash.
+        self.assertTrue(helpers.check_password(self.user, u'secret-password'))
+        self.assertEqual(self.nb_verify, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
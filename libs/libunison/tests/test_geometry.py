@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""Tests of the distances and of the spatial index (libunison.geometry)."""
+
+import libunison.geometry as geometry
+import numpy as np
+import random
+import unittest
+
+from libunison.geometry import Point
+
+
+class TestDistances(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(0)
+        self.points = [Point(rand.uniform(-90, 90), rand.uniform(-180, 180))
+                for i in range(20)]
+        self.lats = [p.lat for p in self.points]
+        self.lons = [p.lon for p in self.points]
+
+    def test_distance_many(self):
+        origin = Point(46.52, 6.57)
+        dists = geometry.distance_many(origin, self.lats, self.lons)
+        expected = [geometry.distance(origin, p) for p in self.points]
+        self.assertTrue(np.allclose(dists, expected, rtol=0, atol=1e-3))
+
+    def test_pairwise(self):
+        dists = geometry.pairwise_distances(self.lats, self.lons)
+        self.assertEqual(dists.shape, (20, 20))
+        for i, a in enumerate(self.points):
+            for j, b in enumerate(self.points):
+                self.assertAlmostEqual(dists[i, j],
+                        geometry.distance(a, b), places=3)
+        self.assertTrue(np.all(np.diag(dists) == 0))
+
+
+class TestGridIndex(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(0)
+        self.points = dict()
+        # Spread over the earth, plus clusters near the antimeridian and the
+        # north pole, where the cells are the most distorted.
+        for i in range(300):
+            self.points[i] = Point(rand.uniform(-90, 90),
+                    rand.uniform(-180, 180))
+        for i in range(300, 400):
+            self.points[i] = Point(rand.uniform(-5, 5),
+                    rand.choice((-1, 1)) * rand.uniform(175, 180))
+        for i in range(400, 500):
+            self.points[i] = Point(rand.uniform(85, 90),
+                    rand.uniform(-180, 180))
+        self.index = geometry.GridIndex(cell_size=2.0)
+        for key, point in self.points.iteritems():
+            self.index.add(key, point)
+        self.queries = [Point(46.52, 6.57), Point(0, 179.9), Point(0, -179.9),
+                Point(89.9, 0), Point(-89.9, 42)]
+
+    def brute_force(self, point):
+        return sorted((geometry.distance(point, p), key)
+                for key, p in self.points.iteritems())
+
+    def test_within(self):
+        for point in self.queries:
+            expected = self.brute_force(point)
+            for radius in (1e4, 3e5, 2e6, 3e7):
+                res = self.index.within(point, radius)
+                self.assertEqual(sorted(key for key, dist in res),
+                        sorted(key for dist, key in expected
+                            if dist <= radius))
+                dists = [dist for key, dist in res]
+                self.assertEqual(dists, sorted(dists))
+
+    def test_nearest(self):
+        for point in self.queries:
+            expected = self.brute_force(point)
+            for k in (1, 5, 50):
+                res = self.index.nearest(point, k)
+                self.assertEqual(len(res), k)
+                self.assertTrue(np.allclose([dist for key, dist in res],
+                        [dist for dist, key in expected[:k]]))
+
+    def test_nearest_all(self):
+        res = self.index.nearest(Point(0, 0), 1000)
+        self.assertEqual(len(res), len(self.points))
+        self.assertEqual(geometry.GridIndex().nearest(Point(0, 0), 3), [])
+
+    def test_update(self):
+        self.assertEqual(len(self.index), 500)
+        self.index.add(0, Point(10, 10))  # Moves the point.
+        self.assertEqual(len(self.index), 500)
+        self.assertEqual(self.index.nearest(Point(10, 10), 1)[0][0], 0)
+        self.index.remove(0)
+        self.index.remove(0)
+        self.assertFalse(0 in self.index)
+        self.assertEqual(len(self.index), 499)
+        self.assertFalse(0 in [key for key, dist
+                in self.index.within(Point(10, 10), 1e6)])
+
+
+if __name__ == '__main__':
+    unittest.main()
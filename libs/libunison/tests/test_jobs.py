@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""Tests of the training job queues (libunison.jobs).
+
+The local and SQLite queues follow the same protocol as the database queue:
+jobs are claimed by pop, then either deleted (done) or released (retry).
+"""
+
+import libunison.jobs as jobs
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+class TestRetryDelay(unittest.TestCase):
+
+    def test_backoff(self):
+        self.assertEqual(jobs.retry_delay(1), jobs.RETRY_DELAY)
+        self.assertEqual(jobs.retry_delay(2), 2 * jobs.RETRY_DELAY)
+        self.assertEqual(jobs.retry_delay(100), jobs.MAX_RETRY_DELAY)
+
+
+class QueueTests(object):
+    """Tests shared by the queues, see make_queue."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self._time = jobs.time
+        jobs.time = self.clock
+        self.queue = self.make_queue()
+
+    def tearDown(self):
+        jobs.time = self._time
+
+    def wait(self, seconds):
+        self.clock.now += seconds
+
+    def test_empty(self):
+        self.assertEqual(self.queue.pop(), None)
+
+    def test_coalesce(self):
+        self.queue.push(1, 2)
+        self.queue.push(1, 3)
+        self.wait(1)
+        self.queue.push(2, 1)
+        self.queue.push(2, None)
+        self.assertEqual(self.queue.pop(), (1, 5))
+        self.assertEqual(self.queue.pop(), (2, None))
+        self.assertEqual(self.queue.pop(), None)
+
+    def test_done(self):
+        self.queue.push(1, 2)
+        self.assertEqual(self.queue.pop(), (1, 2))
+        self.queue.done(1)
+        self.assertEqual(self.queue.pop(), None)
+
+    def test_claim(self):
+        self.queue.push(1, 2)
+        self.wait(1)
+        self.queue.push(2, 1)
+        self.assertEqual(self.queue.pop(), (1, 2))
+        # Enqueued again while it runs: not handed to another worker...
+        self.queue.push(1, 3)
+        self.assertEqual(self.queue.pop(), (2, 1))
+        self.assertEqual(self.queue.pop(), None)
+        # ... but processed again once the running job is done.
+        self.queue.done(1)
+        self.assertEqual(self.queue.pop()[0], 1)
+
+    def test_retry(self):
+        self.queue.push(1, 2)
+        self.queue.pop()
+        self.assertTrue(self.queue.retry(1))
+        # The job is due after the backoff.
+        self.assertEqual(self.queue.pop(), None)
+        self.wait(jobs.retry_delay(1))
+        self.assertEqual(self.queue.pop(), (1, 2))
+
+    def test_park(self):
+        self.queue.push(1, 2)
+        for attempt in range(1, jobs.MAX_ATTEMPTS + 1):
+            self.assertEqual(self.queue.pop(), (1, 2))
+            retried = self.queue.retry(1)
+            self.assertEqual(retried, attempt < jobs.MAX_ATTEMPTS)
+            self.wait(jobs.MAX_RETRY_DELAY)
+        # The parked job doesn't block the others.
+        self.queue.push(2, 1)
+        self.assertEqual(self.queue.pop(), (2, 1))
+        self.assertEqual(self.queue.pop(), None)
+        # Enqueuing the user again gives the job another chance.
+        self.queue.push(1, 3)
+        self.assertEqual(self.queue.pop(), (1, 5))
+        self.assertTrue(self.queue.retry(1))
+
+
+class TestLocalQueue(QueueTests, unittest.TestCase):
+
+    def make_queue(self):
+        return jobs.LocalQueue()
+
+
+class TestSQLiteQueue(QueueTests, unittest.TestCase):
+
+    def make_queue(self):
+        self.dir = tempfile.mkdtemp()
+        return jobs.SQLiteQueue(os.path.join(self.dir, 'jobs.db'))
+
+    def tearDown(self):
+        QueueTests.tearDown(self)
+        shutil.rmtree(self.dir)
+
+    def test_migrate(self):
+        # Queue created before jobs were claimed.
+        path = os.path.join(self.dir, 'old.db')
+        conn = sqlite3.connect(path)
+        conn.execute("""CREATE TABLE model_job (user_id INTEGER PRIMARY KEY,
+            queued REAL NOT NULL, delta INTEGER)""")
+        conn.execute("INSERT INTO model_job VALUES (1, 0, 2)")
+        conn.commit()
+        conn.close()
+        queue = jobs.SQLiteQueue(path)
+        self.assertEqual(queue.pop(), (1, 2))
+        queue.done(1)
+        self.assertEqual(queue.pop(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""Tests of the bulk ingestion of libraries (libentry_views, in the API).
+
+The queries are specific to PostgreSQL: the tests need a database with the
+schema (see schema.sql), given by the UNISON_TEST_DATABASE environment
+variable, e.g. `postgres://localhost/unison_test`. Every test runs in a
+transaction that is rolled back.
+"""
+
+import flask
+import os
+import os.path
+import sys
+import unittest
+
+from libunison.models import User, Track, LibEntry
+from storm.locals import Store, create_database
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', '..', '..', 'api', 'unison'))
+import libentry_views
+
+
+DATABASE = os.environ.get('UNISON_TEST_DATABASE')
+
+
+@unittest.skipUnless(DATABASE, "UNISON_TEST_DATABASE isn't set")
+class TestAddLibEntries(unittest.TestCase):
+
+    def setUp(self):
+        self.store = Store(create_database(DATABASE))
+        self.context = flask.Flask(__name__).test_request_context()
+        self.context.push()
+        flask.g.store = self.store
+        self.user = self.store.add(User(u'test@example.com', u'x'))
+        self.store.flush()
+
+    def tearDown(self):
+        self.context.pop()
+        self.store.rollback()
+        self.store.close()
+
+    def add_track(self, artist, title):
+        track = Track(artist, title)
+        self.store.add(track)
+        self.store.flush()
+        return track
+
+    def add_entry(self, track, is_local, local_id=None, rating=None):
+        entry = LibEntry(self.user, track, is_valid=True)
+        entry.is_local = is_local
+        entry.local_id = local_id
+        entry.rating = rating
+        self.store.add(entry)
+        self.store.flush()
+        return entry
+
+    def entries(self):
+        """Get the valid entries of the user, by (artist, title)."""
+        rows = self.store.find((Track.artist, Track.title, LibEntry),
+                LibEntry.user == self.user, LibEntry.is_valid,
+                LibEntry.track_id == Track.id)
+        res = dict()
+        for artist, title, entry in rows:
+            self.assertFalse((artist, title) in res)
+            res[(artist, title)] = entry
+        return res
+
+    def test_new_tracks(self):
+        self.add_track(u'Old', u'Track')
+        created = libentry_views.add_lib_entries(self.user, [
+          (u'Old', u'Track', 1),
+          (u'New', u'Track', 2),
+        ])
+        self.assertEqual(created, [(u'New', u'Track')])
+        entries = self.entries()
+        self.assertEqual(sorted(entries), [(u'New', u'Track'),
+                (u'Old', u'Track')])
+        for entry in entries.values():
+            self.assertTrue(entry.is_local)
+        self.assertEqual(entries[(u'New', u'Track')].local_id, 2)
+
+    def test_duplicates(self):
+        libentry_views.add_lib_entries(self.user, [
+          (u'Artist', u'Title', 1),
+          (u'Artist', u'Title', 2),
+        ])
+        entries = self.entries()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[(u'Artist', u'Title')].local_id, 2)
+
+    def test_make_local(self):
+        # A rating of a track that isn't in the user's library.
+        track = self.add_track(u'Rated', u'Track')
+        entry = self.add_entry(track, False, rating=5)
+        libentry_views.add_lib_entries(self.user, [(u'Rated', u'Track', 3)])
+        self.store.invalidate()
+        entries = self.entries()
+        self.assertEqual(entries[(u'Rated', u'Track')].id, entry.id)
+        self.assertTrue(entry.is_local)
+        self.assertEqual(entry.local_id, 3)
+        self.assertEqual(entry.rating, 5)
+
+    def test_replace_local(self):
+        track = self.add_track(u'Local', u'Track')
+        entry = self.add_entry(track, True, local_id=1)
+        libentry_views.add_lib_entries(self.user, [(u'Local', u'Track', 4)])
+        self.store.invalidate()
+        self.assertFalse(entry.is_valid)
+        new = self.entries()[(u'Local', u'Track')]
+        self.assertNotEqual(new.id, entry.id)
+        self.assertEqual(new.local_id, 4)
+
+    def test_bulk(self):
+        # More entries than fit in a single statement.
+        nb_entries = libentry_views.BULK_SIZE + 10
+        triples = [(u'Artist', u'Title %d' % i, i) for i in range(nb_entries)]
+        created = libentry_views.add_lib_entries(self.user, triples)
+        self.assertEqual(len(created), nb_entries)
+        entries = self.entries()
+        self.assertEqual(len(entries), nb_entries)
+        for artist, title, local_id in triples:
+            self.assertEqual(entries[(artist, title)].local_id, local_id)
+        ids, created = libentry_views.get_tracks(
+                [(artist, title) for artist, title, local_id in triples])
+        self.assertEqual(created, [])
+        self.assertEqual(sorted(ids.values()), sorted(entry.track_id
+                for entry in entries.values()))
+
+    def test_empty(self):
+        self.assertEqual(libentry_views.add_lib_entries(self.user, []), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
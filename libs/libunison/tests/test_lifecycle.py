@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""Tests of the request lifecycle (libunison.lifecycle)."""
+
+import flask
+import libunison.lifecycle as lifecycle
+import os
+import os.path
+import shutil
+import storm.locals
+import tempfile
+import threading
+import time
+import unittest
+
+
+class BrokenStore(object):
+    """Store whose connection was lost."""
+
+    def __init__(self):
+        self.closed = False
+
+    def rollback(self):
+        raise IOError("connection lost")
+
+    def close(self):
+        self.closed = True
+
+
+class TestStorePool(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        conn_str = 'sqlite:%s' % os.path.join(self.dir, 'test.db')
+        self.pool = lifecycle.StorePool(conn_str, size=2, timeout=0.05)
+        store = self.pool.acquire()
+        store.execute("CREATE TABLE item (id INTEGER PRIMARY KEY)")
+        store.commit()
+        self.pool.release(store)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_reuse(self):
+        store = self.pool.acquire()
+        self.pool.release(store)
+        self.assertTrue(self.pool.acquire() is store)
+
+    def test_rollback(self):
+        store = self.pool.acquire()
+        store.execute("INSERT INTO item VALUES (1)")
+        self.pool.release(store)
+        store = self.pool.acquire()
+        self.assertEqual(store.execute("SELECT * FROM item").get_all(), [])
+
+    def test_exhausted(self):
+        stores = [self.pool.acquire(), self.pool.acquire()]
+        self.assertFalse(stores[0] is stores[1])
+        self.assertRaises(lifecycle.PoolExhausted, self.pool.acquire)
+
+    def test_wait(self):
+        self.pool._timeout = 5
+        stores = [self.pool.acquire(), self.pool.acquire()]
+        timer = threading.Timer(0.05, self.pool.release, [stores[0]])
+        timer.start()
+        self.assertTrue(self.pool.acquire() is stores[0])
+        timer.join()
+
+    def test_broken(self):
+        stores = [self.pool.acquire(), self.pool.acquire()]
+        broken = BrokenStore()
+        self.pool.release(broken)
+        self.assertTrue(broken.closed)
+        # A new store replaces the broken one.
+        self.pool.release(stores[1])
+        self.pool.acquire()
+        self.assertFalse(self.pool.acquire() in stores)
+
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'config.yaml')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, text, mtime):
+        with open(self.path, 'w') as f:
+            f.write(text)
+        os.utime(self.path, (mtime, mtime))
+
+    def test_reload(self):
+        now = time.time()
+        self.write("a: 1\n", now - 10)
+        config = lifecycle.Config(self.path)
+        self.assertEqual(config.get(), {'a': 1})
+        self.assertTrue(config.get() is config.get())
+        self.write("a: 2\n", now)
+        self.assertEqual(config.get(), {'a': 2})
+
+
+class TestInitApp(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        conn_str = 'sqlite:%s' % os.path.join(self.dir, 'test.db')
+        with open(os.path.join(self.dir, 'config.yaml'), 'w') as f:
+            f.write("database:\n  string: '%s'\n  pool: 1\n" % conn_str)
+        self.store = storm.locals.Store(storm.locals.create_database(conn_str))
+        self.store.execute("CREATE TABLE item (id INTEGER PRIMARY KEY)")
+        self.store.commit()
+        app = flask.Flask(__name__)
+        lifecycle.init_app(app)
+
+        @app.route('/insert/<int:value>')
+        def insert(value):
+            flask.g.store.execute("INSERT INTO item VALUES (?)", (value,))
+            if value == 0:
+                raise ValueError("invalid value")
+            return 'ok'
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def get(self, path):
+        return self.client.get(path, environ_base={'UNISON_ROOT': self.dir})
+
+    def items(self):
+        self.store.rollback()
+        return [row[0] for row
+                in self.store.execute("SELECT id FROM item ORDER BY id")]
+
+    def test_commit(self):
+        self.get('/insert/1')
+        # The (single) store of the pool was released after the request.
+        self.get('/insert/2')
+        self.assertEqual(self.items(), [1, 2])
+
+    def test_failure(self):
+        self.assertEqual(self.get('/insert/0').status_code, 500)
+        self.get('/insert/1')
+        self.assertEqual(self.items(), [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""Tests of the password hashing (libunison.password)."""
+
+import libunison.password as password
+import unittest
+
+
+# Hash of u'secret-password' computed by the previous implementation (the
+# `pbkdf2` module, with 1000 iterations), before the versioned format.
+LEGACY_HASH = u'MDEyMzQ1Njc4OWFiY2RlZg==:iDT5ZpkS4f94Qx7WQcuJ9g=='
+
+
+class TestPassword(unittest.TestCase):
+
+    def test_verify(self):
+        encrypted = password.encrypt(u'secret-password')
+        self.assertTrue(encrypted.startswith(u'pbkdf2_sha256$20000$'))
+        self.assertTrue(password.verify(u'secret-password', encrypted))
+        self.assertFalse(password.verify(u'secret-passwore', encrypted))
+
+    def test_salt(self):
+        self.assertNotEqual(password.encrypt(u'secret-password'),
+                password.encrypt(u'secret-password'))
+
+    def test_unicode(self):
+        encrypted = password.encrypt(u'p\xe2ssw\xf6rd')
+        self.assertTrue(password.verify(u'p\xe2ssw\xf6rd', encrypted))
+
+    def test_legacy(self):
+        self.assertTrue(password.verify(u'secret-password', LEGACY_HASH))
+        self.assertFalse(password.verify(u'secret-passwore', LEGACY_HASH))
+
+    def test_needs_rehash(self):
+        self.assertTrue(password.needs_rehash(LEGACY_HASH))
+        self.assertFalse(password.needs_rehash(
+                password.encrypt(u'secret-password')))
+        # Hashes with fewer iterations than the current setting.
+        weak = password.encrypt(u'secret-password',
+                iterations=password.NB_ITERATIONS // 2)
+        self.assertTrue(password.verify(u'secret-password', weak))
+        self.assertTrue(password.needs_rehash(weak))
+
+
+if __name__ == '__main__':
+    unittest.main()
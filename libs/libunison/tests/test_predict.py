@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""Regression tests of the rank aggregation (predict.mc4).
+
+data/mc4_corpus.json holds rankings aggregated by the original implementation
+(one transition matrix and eigendecomposition per pass). Each case gives the
+ratings, and the resulting ranking as a list of groups of tied items, i.e.
+items of a pass that had the same stationary probability. The original order
+within a group was arbitrary. Probabilities were rounded to 1e-9, as the
+solver's noise sometimes made zero probabilities slightly positive.
+
+Run from libs/libunison with `python -m unittest discover tests`.
+"""
+
+import json
+import libunison.predict as predict
+import numpy as np
+import os.path
+import unittest
+
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), 'data', 'mc4_corpus.json')
+
+
+class TestMC4(unittest.TestCase):
+
+    def setUp(self):
+        with open(CORPUS_PATH) as f:
+            self.cases = json.load(f)
+
+    def test_same_ranking_up_to_ties(self):
+        for i, case in enumerate(self.cases):
+            ranking = list(predict.mc4(case['ratings']))
+            start = 0
+            for group in case['ranking']:
+                end = start + len(group)
+                self.assertEqual(sorted(ranking[start:end]), group,
+                        "case %d: items %d-%d differ" % (i, start, end))
+                start = end
+            self.assertEqual(len(ranking), start)
+
+    def test_ties_keep_the_items_order(self):
+        for i, case in enumerate(self.cases):
+            ranking = list(predict.mc4(case['ratings']))
+            start = 0
+            for group in case['ranking']:
+                end = start + len(group)
+                self.assertEqual(ranking[start:end], group,
+                        "case %d: ties not in item order" % i)
+                start = end
+
+    def test_warm_start(self):
+        # The initial distribution only changes the work of the solver.
+        rng = np.random.RandomState(0)
+        for i, case in enumerate(self.cases):
+            start = rng.random_sample(len(case['ratings'][0]))
+            passes = predict.mc4_iter(case['ratings'], start=start)
+            ranking = list(np.concatenate(list(passes)))
+            self.assertEqual(ranking, list(predict.mc4(case['ratings'])),
+                    "case %d: ranking differs" % i)
+
+
+if __name__ == '__main__':
+    unittest.main()
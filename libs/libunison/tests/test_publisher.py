@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""Tests of the publication of jobs to the message queue (libunison.publisher).
+
+The AMQP connection is replaced by a fake one, which confirms the published
+messages (or not) when its events are processed. The spilling of messages is
+tested with the in-memory broker.
+"""
+
+import libunison.publisher as publisher
+import logging
+import os
+import os.path
+import pika
+import pika.spec
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class FakeFrame(object):
+
+    def __init__(self, method):
+        self.method = method
+
+
+class FakeCallbacks(object):
+
+    def __init__(self):
+        self.callbacks = dict()
+
+    def add(self, prefix, key, callback, one_shot=True):
+        self.callbacks[key] = callback
+
+
+class FakeChannel(object):
+    """Channel that only delivers the acks to confirm_delivery's callback,
+    like pika 0.9.5."""
+
+    channel_number = 1
+
+    def __init__(self):
+        self.callbacks = FakeCallbacks()
+        self.published = list()
+
+    def queue_declare(self, queue, durable=False):
+        pass
+
+    def confirm_delivery(self, callback):
+        self.callbacks.add(self.channel_number, pika.spec.Basic.Ack, callback)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published.append(body)
+
+
+class FakeConnection(object):
+    """Connection that answers the publications with `reply` (an ack, a nack,
+    or nothing if None) for all the messages at once."""
+
+    reply = pika.spec.Basic.Ack
+
+    def __init__(self, parameters):
+        self.chan = FakeChannel()
+        self.confirmed = 0
+
+    def channel(self):
+        return self.chan
+
+    def process_data_events(self):
+        if self.reply is None or self.confirmed == len(self.chan.published):
+            return
+        self.confirmed = len(self.chan.published)
+        method = self.reply(delivery_tag=self.confirmed, multiple=True)
+        # Replies without a callback are dropped.
+        callback = self.chan.callbacks.callbacks.get(self.reply)
+        if callback is not None:
+            callback(FakeFrame(method))
+
+    def close(self):
+        pass
+
+
+class TestAMQPBroker(unittest.TestCase):
+
+    def setUp(self):
+        self._connection_cls = pika.BlockingConnection
+        pika.BlockingConnection = FakeConnection
+        self.broker = publisher.AMQPBroker('localhost', 'test', timeout=0.05)
+
+    def tearDown(self):
+        pika.BlockingConnection = self._connection_cls
+        FakeConnection.reply = pika.spec.Basic.Ack
+
+    def test_ack(self):
+        self.broker.publish(['a', 'b'])
+        self.broker.publish(['c'])
+        self.assertEqual(self.broker._conn.chan.published, ['a', 'b', 'c'])
+        self.assertEqual(len(self.broker._unconfirmed), 0)
+
+    def test_nack(self):
+        FakeConnection.reply = pika.spec.Basic.Nack
+        self.broker._timeout = 5
+        start = time.time()
+        self.assertRaises(publisher.BrokerError, self.broker.publish, ['a'])
+        # We don't wait for the timeout.
+        self.assertTrue(time.time() - start < 1)
+        # The connection can still be used.
+        FakeConnection.reply = pika.spec.Basic.Ack
+        self.broker.publish(['b'])
+
+    def test_timeout(self):
+        FakeConnection.reply = None
+        self.assertRaises(publisher.BrokerError, self.broker.publish, ['a'])
+        # The connection was closed, the next batch uses a new one.
+        self.assertTrue(self.broker._conn is None)
+        FakeConnection.reply = pika.spec.Basic.Ack
+        self.broker.publish(['b'])
+        self.assertEqual(self.broker._conn.chan.published, ['b'])
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+class TestPublisher(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self._time = publisher.time
+        publisher.time = self.clock
+        self.dir = tempfile.mkdtemp()
+        self.spill_path = os.path.join(self.dir, 'test.spill')
+        self.broker = publisher.MemoryBroker()
+        logger = logging.getLogger('test_publisher')
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        self.publisher = publisher.Publisher(self.broker, self.spill_path,
+                logger=logger)
+
+    def tearDown(self):
+        publisher.time = self._time
+        shutil.rmtree(self.dir)
+
+    def spilled(self):
+        if not os.path.exists(self.spill_path):
+            return list()
+        with open(self.spill_path) as f:
+            return f.read().splitlines()
+
+    def test_publish(self):
+        self.assertTrue(self.publisher.publish(['a', 'b']))
+        self.assertTrue(self.publisher.publish([]))
+        self.assertEqual(self.broker.messages, ['a', 'b'])
+        self.assertEqual(self.spilled(), [])
+
+    def test_spill(self):
+        self.broker.is_down = True
+        self.assertFalse(self.publisher.publish(['a']))
+        self.assertEqual(self.spilled(), ['a'])
+        # The broker isn't tried again before the retry delay...
+        self.broker.is_down = False
+        self.assertFalse(self.publisher.publish(['b']))
+        self.assertEqual(self.spilled(), ['a', 'b'])
+        self.assertEqual(self.broker.messages, [])
+        # ... after which the spilled messages are replayed.
+        self.clock.now += publisher.RETRY_DELAY + 1
+        self.assertTrue(self.publisher.publish(['c']))
+        self.assertEqual(self.broker.messages, ['c', 'a', 'b'])
+        self.assertEqual(self.spilled(), [])
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_replay_fails(self):
+        self.broker.is_down = True
+        self.publisher.publish(['a'])
+        self.clock.now += publisher.RETRY_DELAY + 1
+        # The broker goes down again between the publish and the replay.
+        publish = self.broker.publish
+        def publish_once(bodies):
+            publish(bodies)
+            self.broker.is_down = True
+        self.broker.is_down = False
+        self.broker.publish = publish_once
+        self.assertTrue(self.publisher.publish(['b']))
+        self.assertEqual(self.broker.messages, ['b'])
+        # The spilled messages are kept for the next replay.
+        self.assertEqual(self.spilled(), ['a'])
+        self.broker.publish = publish
+        self.broker.is_down = False
+        self.assertFalse(self.publisher.publish(['c']))
+        self.clock.now += publisher.RETRY_DELAY + 1
+        self.assertTrue(self.publisher.publish(['d']))
+        self.assertEqual(self.broker.messages, ['b', 'd', 'a', 'c'])
+        self.assertEqual(self.spilled(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
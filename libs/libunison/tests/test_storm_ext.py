@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""Tests of the custom Storm properties (libunison._storm_ext)."""
+
+import libunison._storm_ext as storm_ext
+import libunison.utils as utils
+import numpy as np
+import unittest
+
+
+class TestFeatures(unittest.TestCase):
+
+    def setUp(self):
+        self.vector = [0.5, -1.25, 3.0]
+        self.raw = np.array(self.vector, dtype='>f4').tostring()
+
+    def test_set_vector(self):
+        var = storm_ext.FeaturesVariable()
+        var.set(self.vector)
+        self.assertEqual(list(var.get()), self.vector)
+        self.assertEqual(str(var.get(to_db=True)), self.raw)
+
+    def test_from_db(self):
+        var = storm_ext.FeaturesVariable()
+        var.set(buffer(self.raw), from_db=True)
+        value = var.get()
+        self.assertEqual(value.dtype, utils.FEATURES_DTYPE)
+        self.assertEqual(list(value), self.vector)
+        # The array is a view of the raw data.
+        self.assertFalse(value.flags.writeable)
+
+    def test_base64(self):
+        # The old text format.
+        encoded = utils.encode_features(self.vector)
+        for from_db in (True, False):
+            var = storm_ext.FeaturesVariable()
+            var.set(encoded, from_db=from_db)
+            self.assertEqual(list(var.get()), self.vector)
+
+    def test_invalid(self):
+        var = storm_ext.FeaturesVariable()
+        self.assertRaises(TypeError, var.set, 42, from_db=True)
+        self.assertRaises(TypeError, var.set, ['a', 'b'])
+
+    def test_codec(self):
+        var = storm_ext.FeaturesVariable()
+        var.set(buffer(self.raw), from_db=True)
+        self.assertEqual(utils.decode_features(var.get()), self.vector)
+        self.assertEqual(list(utils.decode_features_many([var.get()])[0]),
+                self.vector)
+
+
+if __name__ == '__main__':
+    unittest.main()
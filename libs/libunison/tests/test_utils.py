@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""Tests of the feature vector codec (libunison.utils)."""
+
+import libunison.utils as utils
+import numpy as np
+import unittest
+
+
+class TestFeaturesCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.matrix = np.array([[0.5, -1.25, 3.0], [0.0, 1e-3, -7.5]])
+
+    def test_encode_many(self):
+        encoded = utils.encode_features_many(self.matrix)
+        self.assertEqual(encoded,
+                [utils.encode_features(list(row)) for row in self.matrix])
+
+    def test_decode_many(self):
+        encoded = utils.encode_features_many(self.matrix)
+        decoded = utils.decode_features_many(encoded)
+        self.assertEqual(decoded.dtype, np.float32)
+        self.assertTrue(np.allclose(decoded, self.matrix))
+        for enc, row in zip(encoded, decoded):
+            self.assertEqual(utils.decode_features(enc), list(row))
+
+    def test_decode_arrays(self):
+        # Vectors as read from a Features property.
+        arrays = [row.astype(utils.FEATURES_DTYPE) for row in self.matrix]
+        encoded = utils.encode_features_many(self.matrix)
+        mixed = [arrays[0], encoded[1]]
+        self.assertTrue(np.array_equal(utils.decode_features_many(mixed),
+                utils.decode_features_many(encoded)))
+
+    def test_decode_empty(self):
+        self.assertEqual(utils.decode_features_many([], dim=3).shape, (0, 3))
+
+    def test_decode_dimensions(self):
+        encoded = [utils.encode_features([1.0, 2.0]),
+                utils.encode_features([1.0])]
+        self.assertRaises(ValueError, utils.decode_features_many, encoded)
+
+
+if __name__ == '__main__':
+    unittest.main()
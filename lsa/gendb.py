@@ -9,6 +9,10 @@ It takes as input:
   to its column in the matrix
 - the *-Ut matrix output by SVDLIBC, in dense binary format. Each row in this
   matrix corresponds to a latent concept, and each column to a tag.
+
+Next to the database, it also writes the tag space used by libunison: a tag
+name to row index, and memory-mappable matrices of vectors and weights (see
+libunison.utils.TagSpace).
 """
 
 import argparse
@@ -17,7 +21,7 @@ import sqlite3
 import struct
 
 from libunison.utils import (DB_PATH, TAGS_PATH, WEIGHTS_PATH, UT_PATH,
-        load_tags, load_weights, create_tree)
+        TagSpace, load_tags, load_weights, create_tree)
 
 
 TABLE_SCHEMA = """
@@ -71,6 +75,12 @@ def populate_db(tags_dict, weights, vectors, db_file):
     conn.commit()
 
 
+def write_tag_space(db_file):
+    """Write the tag space files next to the database."""
+    conn = sqlite3.connect(db_file)
+    TagSpace.from_db(conn).dump(db_file)
+
+
 def init_db(db_file):
     """Small helper to (re)initalize the database."""
     create_tree(db_file)
@@ -90,17 +100,22 @@ def _parse_args():
     parser.add_argument('--weights', '-w', default=WEIGHTS_PATH)
     parser.add_argument('--dim', '-d', type=int, default=-1)
     parser.add_argument('--out', '-o', default=DB_PATH)
+    # Only regenerate the tag space from an existing database.
+    parser.add_argument('--tag-space', action='store_true')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     args = _parse_args()
-    print "Unmarshalling the tags dictionnary..."
-    tags_dict = load_tags(args.tags)
-    print "Unmarshalling the weights list..."
-    weights = load_weights(args.weights)
-    print "Read the feature vectors from the matrix..."
-    vectors = read_vectors(args.matrix, max_dim=args.dim)
-    print "Generate the database..."
-    populate_db(tags_dict, weights, vectors, args.out)
+    if not args.tag_space:
+        print "Unmarshalling the tags dictionnary..."
+        tags_dict = load_tags(args.tags)
+        print "Unmarshalling the weights list..."
+        weights = load_weights(args.weights)
+        print "Read the feature vectors from the matrix..."
+        vectors = read_vectors(args.matrix, max_dim=args.dim)
+        print "Generate the database..."
+        populate_db(tags_dict, weights, vectors, args.out)
+    print "Generate the tag space..."
+    write_tag_space(args.out)
     print "Done."
@@ -23,7 +23,7 @@ CREATE TABLE "user" (
   group_id       bigint,
   location       point,
   location_timestamp timestamp NOT NULL DEFAULT '1970-01-01 00:00:00',
-  model          text -- Base64 encoded.
+  model          text -- Compact encoding, see libunison.predict.encode_model.
 );
 CREATE INDEX user_group_idx ON "user"(group_id);
 
@@ -42,24 +42,41 @@ CREATE TABLE "group" (
   password       text,
   update_time    timestamp NOT NULL DEFAULT now(),
   automatic      boolean NOT NULL DEFAULT FALSE,
-  active         boolean NOT NULL DEFAULT FALSE
+  active         boolean NOT NULL DEFAULT FALSE,
+  state_version  integer NOT NULL DEFAULT 0 -- Members or master changes.
 );
 -- Add the foreign key constraint on user(group_id).
 ALTER TABLE "user" ADD CONSTRAINT group_fk FOREIGN KEY (group_id)
     REFERENCES "group";
 CREATE INDEX automatic_idx ON "group" (automatic);
+-- Groups are indexed by location in memory by the API, which fetches the
+-- recently updated ones (e.g. deactivated) to keep its index up to date.
+CREATE INDEX group_update_time_idx ON "group" (update_time);
+CREATE TRIGGER group_update_time_trigger BEFORE UPDATE
+    ON "group" FOR EACH ROW EXECUTE PROCEDURE update_time_column();
 
 CREATE TABLE "cluster" (
   id                bigserial PRIMARY KEY,
   position          point NOT NULL,
+  cell_id           bigint NOT NULL UNIQUE, -- See geometry.cell_id.
   group_id          bigint UNIQUE REFERENCES "group"
 --  users_in_cluster  bigint
 );
-CREATE INDEX position_idx ON "cluster" USING gist (box(position,position));
 CREATE INDEX group_id_idx ON "cluster" (group_id);
 ALTER TABLE "user" ADD COLUMN cluster_id bigint REFERENCES "cluster";
 CREATE INDEX cluster_id_idx ON "user" (cluster_id);
 
+-- Pending model training jobs (see libunison.jobs), at most one per user.
+CREATE TABLE model_job (
+  user_id        bigint PRIMARY KEY REFERENCES "user",
+  queued         timestamp NOT NULL DEFAULT now(),
+  delta          integer, -- Number of library changes, NULL if unknown.
+  started        timestamp, -- When a worker claimed the job, if it did.
+  seq            integer NOT NULL DEFAULT 0, -- Incremented on each push.
+  attempts       integer NOT NULL DEFAULT 0 -- Failures since the last push.
+);
+CREATE INDEX model_job_queued_idx ON model_job(queued);
+
 
 CREATE TABLE track (
   id             bigserial PRIMARY KEY,
@@ -70,7 +87,7 @@ CREATE TABLE track (
   image          text, -- As a URL.
   listeners      integer, -- Number of listeners on last.fm.
   tags           text, -- JSON array.
-  features       text, -- Base64 encoded.
+  features       bytea, -- Big-endian 4-byte floats.
   UNIQUE (artist, title)
 );
 CREATE INDEX track_artist_title_idx ON track(artist, title);
@@ -108,9 +125,12 @@ CREATE TABLE group_event (
   user_id        bigint REFERENCES "user",
   group_id       bigint REFERENCES "group",
   event_type     group_event_type NOT NULL,
-  payload        text -- JSON encoded.
+  payload        text, -- JSON encoded.
+  track_id       bigint REFERENCES track -- For play, skip and rating events.
 );
-CREATE INDEX group_event_group_idx ON group_event(group_id);
+-- Recent events of a given type, e.g. the tracks played in a group.
+CREATE INDEX group_event_group_type_idx
+    ON group_event(group_id, event_type, creation_time);
 CREATE INDEX group_event_creation_time_idx ON group_event(creation_time);
 
 -- Following tables are used for single-user mode
@@ -126,7 +146,7 @@ CREATE TABLE playlist (
   listeners      integer DEFAULT 0, -- Number of listeners (users who added this playlist to their own library).
   seeds          text NOT NULL, -- JSONObject
   options        text, --JSONObject
-  features       text NOT NULL, -- Base64 encoded
+  features       bytea NOT NULL, -- Big-endian 4-byte floats.
   avg_rating     real,
   valid          boolean NOT NULL DEFAULT FALSE,
   shared         boolean NOT NULL DEFAULT FALSE -- to other GroupStreamer users
@@ -160,7 +180,7 @@ CREATE TABLE top_tag (
   creation_time  timestamp NOT NULL DEFAULT now(),
   name           text NOT NULL, -- from last.fm API
   ref_id         bigint NOT NULL, -- hash of name
-  features       text NOT NULL, -- Base64 encoded
+  features       bytea NOT NULL, -- Big-endian 4-byte floats.
   count          bigint, -- from last.fm API
   url            text -- from last.fm API,
 );
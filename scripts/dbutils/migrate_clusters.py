@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Add the grid cell IDs (see geometry.cell_id) to the existing clusters.
+
+The cell of a cluster is recovered from its position. Clusters that end up in
+the same cell are merged: their users are moved to the one that has a group
+(or to the oldest one), and the others are deleted. The script does nothing
+if the clusters already have cell IDs.
+"""
+
+import argparse
+import collections
+import libunison.geometry as geometry
+import libunison.utils as uutils
+
+from math import cos
+
+
+QUERY_COLUMN = """SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'cluster' AND column_name = 'cell_id'"""
+
+
+def cell_of_position(position):
+    """Get the cell ID of a cluster, given its position.
+
+    Inverts map_location_on_grid, rounding instead of flooring so that
+    floating-point errors don't move the position to a neighboring cell.
+    """
+    vert_angle = geometry.clusterHeight / geometry.EARTH_RADIUS
+    row = int(round(geometry.deg_to_rad(position.lat) / vert_angle))
+    lat = row * vert_angle
+    if cos(lat) == 0:
+        lat = lat + 0.0001
+    col = int(round(geometry.deg_to_rad(position.lon)
+            * geometry.EARTH_RADIUS * cos(lat) / geometry.clusterWidth))
+    return ((row + geometry.MAX_GRID_ROW) * (2 * geometry.MAX_GRID_COL + 1)
+            + (col + geometry.MAX_GRID_COL))
+
+
+def migrate(store, verbose=False):
+    store.execute("ALTER TABLE cluster ADD COLUMN cell_id bigint")
+    cells = collections.defaultdict(list)
+    rows = store.execute("SELECT id, position, group_id FROM cluster")
+    for cid, position, gid in rows:
+        x, y = position.strip('()').split(',')
+        point = geometry.Point(float(x), float(y))
+        cells[cell_of_position(point)].append((gid is None, cid))
+    merged = 0
+    for cell, clusters in cells.iteritems():
+        # Keep the cluster with a group, or the oldest one.
+        clusters.sort()
+        keep = clusters[0][1]
+        others = [cid for has_no_group, cid in clusters[1:]]
+        if len(others) > 0:
+            if verbose:
+                print "merging clusters %r into %d" % (others, keep)
+            store.execute("""UPDATE "user" SET cluster_id = ?
+                WHERE cluster_id IN (%s)""" % ", ".join("?" * len(others)),
+                [keep] + others)
+            store.execute("DELETE FROM cluster WHERE id IN (%s)"
+                    % ", ".join("?" * len(others)), others)
+            merged += len(others)
+        store.execute("UPDATE cluster SET cell_id = ? WHERE id = ?",
+                (cell, keep))
+    store.execute("ALTER TABLE cluster ALTER COLUMN cell_id SET NOT NULL")
+    store.execute("ALTER TABLE cluster ADD UNIQUE (cell_id)")
+    store.execute("DROP INDEX IF EXISTS position_idx")
+    return len(cells), merged
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    store = uutils.get_store()
+    if store.execute(QUERY_COLUMN).get_one() is not None:
+        raise SystemExit("clusters already migrated")
+    nb_cells, nb_merged = migrate(store, args.verbose)
+    print "%d clusters, %d merged" % (nb_cells, nb_merged)
+    if args.dry_run:
+        store.rollback()
+    else:
+        store.commit()
+    print "Done."
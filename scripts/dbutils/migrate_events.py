@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Add the track IDs to the group events.
+
+Adds the `track_id` column of group_event and the index on (group_id,
+event_type, creation_time), which replaces the index on group_id alone. The
+track of the existing play, skip and rating events is recovered from the
+artist and title in their payload. The column and the index are only created
+if they don't exist yet, so the script can safely be run several times.
+"""
+
+import argparse
+import libunison.utils as uutils
+
+
+QUERY_COLUMN = """SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'group_event' AND column_name = 'track_id'"""
+
+QUERY_BACKFILL = """UPDATE group_event SET track_id = track.id FROM track
+    WHERE group_event.event_type IN ('play', 'skip', 'rating')
+      AND group_event.track_id IS NULL
+      AND track.artist = group_event.payload::json->>'artist'
+      AND track.title = group_event.payload::json->>'title'"""
+
+
+def migrate(store):
+    if store.execute(QUERY_COLUMN).get_one() is None:
+        store.execute("""ALTER TABLE group_event
+            ADD COLUMN track_id bigint REFERENCES track""")
+    else:
+        print "group_event.track_id: already exists"
+    store.execute("""CREATE INDEX IF NOT EXISTS group_event_group_type_idx
+        ON group_event(group_id, event_type, creation_time)""")
+    store.execute("DROP INDEX IF EXISTS group_event_group_idx")
+    result = store.execute(QUERY_BACKFILL)
+    print "group_event: %d events updated" % result.rowcount
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dry-run', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    store = uutils.get_store()
+    migrate(store)
+    if args.dry_run:
+        store.rollback()
+    else:
+        store.commit()
+    print "Done."
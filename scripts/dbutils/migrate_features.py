@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Migrate the feature vectors from base64 text to raw binary (bytea).
+
+Converts the `features` column of the track, top_tag and playlist tables.
+Tables that have already been migrated are skipped, so the script can safely
+be run several times.
+"""
+
+import argparse
+import json
+import libunison.utils as uutils
+import numpy as np
+
+
+QUERY_TYPE = """SELECT data_type FROM information_schema.columns
+    WHERE table_name = ? AND column_name = 'features'"""
+
+# Base64 (URL-safe and unpadded) text can be converted directly by Postgres.
+BASE64_TO_BYTEA = """ALTER TABLE %s ALTER COLUMN features TYPE bytea
+    USING decode(rpad(translate(features, '-_', '+/'),
+        (length(features) + 3) / 4 * 4, '='), 'base64')"""
+
+
+def is_migrated(store, table):
+    data_type, = store.execute(QUERY_TYPE, (table,)).get_one()
+    return data_type == 'bytea'
+
+
+def migrate_base64(store, table):
+    store.execute(BASE64_TO_BYTEA % table)
+
+
+def migrate_playlists(store):
+    """Convert the playlists' features.
+
+    Some of them are stored as the string representation of a list of floats
+    instead of base64 text, so the conversion is done in Python.
+    """
+    store.execute("ALTER TABLE playlist ADD COLUMN features_raw bytea")
+    rows = store.execute("SELECT id, features FROM playlist").get_all()
+    for pid, text in rows:
+        if text.startswith('['):
+            vector = json.loads(text)
+        else:
+            vector = uutils.decode_features(text)
+        raw = np.asarray(vector, dtype=uutils.FEATURES_DTYPE).tostring()
+        store.execute("UPDATE playlist SET features_raw = ? WHERE id = ?",
+                (buffer(raw), pid))
+    store.execute("ALTER TABLE playlist DROP COLUMN features")
+    store.execute(
+            "ALTER TABLE playlist RENAME COLUMN features_raw TO features")
+    store.execute("ALTER TABLE playlist ALTER COLUMN features SET NOT NULL")
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dry-run', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    store = uutils.get_store()
+    for table in ('track', 'top_tag', 'playlist'):
+        if is_migrated(store, table):
+            print "%s: already migrated" % table
+            continue
+        print "%s: migrating..." % table
+        if table == 'playlist':
+            migrate_playlists(store)
+        else:
+            migrate_base64(store, table)
+    if args.dry_run:
+        store.rollback()
+    else:
+        store.commit()
+    print "Done."
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""Update the group table for the API's index and playlists.
+
+- The update time of the groups is maintained by a trigger, and indexed: the
+  API fetches the recently updated groups to keep its in-memory spatial index
+  up to date (see group_views.nearest_groups). The GiST index on the
+  coordinates isn't used anymore, and is dropped.
+- The state version of the groups is added (see group_views.get_playlist_id).
+
+The script can safely be run several times.
+"""
+
+import argparse
+import libunison.utils as uutils
+
+
+QUERY_COLUMN = """SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'group' AND column_name = 'state_version'"""
+
+
+def migrate_index(store):
+    store.execute('DROP TRIGGER IF EXISTS group_update_time_trigger ON "group"')
+    store.execute("""CREATE TRIGGER group_update_time_trigger BEFORE UPDATE
+        ON "group" FOR EACH ROW EXECUTE PROCEDURE update_time_column()""")
+    store.execute("""CREATE INDEX IF NOT EXISTS group_update_time_idx
+        ON "group" (update_time)""")
+    store.execute("DROP INDEX IF EXISTS group_coordinates_idx")
+
+
+def migrate_version(store):
+    if store.execute(QUERY_COLUMN).get_one() is not None:
+        print "group.state_version: already exists"
+        return
+    store.execute("""ALTER TABLE "group"
+        ADD COLUMN state_version integer NOT NULL DEFAULT 0""")
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dry-run', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    store = uutils.get_store()
+    migrate_index(store)
+    migrate_version(store)
+    if args.dry_run:
+        store.rollback()
+    else:
+        store.commit()
+    print "Done."
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""Create or update the table of the model training jobs (see libunison/jobs.py).
+
+The script can safely be run several times.
+"""
+
+import argparse
+import libunison.utils as uutils
+
+
+QUERIES = [
+  """CREATE TABLE IF NOT EXISTS model_job (
+    user_id        bigint PRIMARY KEY REFERENCES "user",
+    queued         timestamp NOT NULL DEFAULT now(),
+    delta          integer)""",
+  "CREATE INDEX IF NOT EXISTS model_job_queued_idx ON model_job(queued)",
+  # Jobs are claimed by the workers while they run.
+  "ALTER TABLE model_job ADD COLUMN IF NOT EXISTS started timestamp",
+  """ALTER TABLE model_job
+    ADD COLUMN IF NOT EXISTS seq integer NOT NULL DEFAULT 0""",
+  # Failed jobs are retried a few times only.
+  """ALTER TABLE model_job
+    ADD COLUMN IF NOT EXISTS attempts integer NOT NULL DEFAULT 0""",
+]
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dry-run', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    store = uutils.get_store()
+    for query in QUERIES:
+        store.execute(query)
+    if args.dry_run:
+        store.rollback()
+    else:
+        store.commit()
+    print "Done."
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""Recompute the feature vectors of the tracks from their tags.
+
+Typically used after the latent space has been rebuilt (see lsa/). Tracks are
+processed in chunks, and all the tracks of a chunk are featurized at once.
+"""
+
+import argparse
+import json
+import libunison.utils as uutils
+import time
+
+from libunison.models import Track
+from storm.locals import *
+
+
+CHUNK_SIZE = 5000  # Number of tracks featurized at once.
+
+
+def update_features(store, only_null=False, chunk_size=CHUNK_SIZE):
+    space = uutils.get_tag_space()
+    condition = (Track.tags != None)
+    if only_null:
+        condition = condition & (Track.features == None)
+    count = 0
+    last_id = 0
+    start = time.time()
+    while True:
+        tracks = list(store.find(Track, condition & (Track.id > last_id))
+                .order_by(Track.id)[:chunk_size])
+        if not tracks:
+            break
+        vectors = uutils.track_features_many(
+                [json.loads(track.tags) for track in tracks], space)
+        for track, features in zip(tracks, vectors):
+            track.features = features
+        store.commit()
+        last_id = tracks[-1].id
+        count += len(tracks)
+        print "%d tracks processed (%.0f tracks/s)" % (
+                count, count / (time.time() - start))
+    return count
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    # Only process the tracks that don't have a feature vector yet.
+    parser.add_argument('--null', action='store_true')
+    parser.add_argument('--chunk', type=int, default=CHUNK_SIZE)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    store = uutils.get_store()
+    update_features(store, only_null=args.null, chunk_size=args.chunk)
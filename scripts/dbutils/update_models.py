@@ -1,36 +1,157 @@
 #!/usr/bin/env python
+"""Retrain the users' models.
+
+Users are processed in chunks, by increasing ID. The points of all the users
+of a chunk are fetched with a single query, their models are fitted in a pool
+of processes, and they are written in one transaction per chunk. The ID of
+the last user written is saved in a checkpoint file, so that an interrupted
+run can be resumed with --resume.
+"""
 
 import argparse
 import libunison.utils as uutils
 import libunison.predict as predict
+import multiprocessing
+import os
+import time
 
-from libunison.models import User
+from libunison.models import User, LibEntry, Track
 from storm.locals import *
 
 
+CHUNK_SIZE = 200  # Number of users processed at once.
+CHECKPOINT_PATH = 'update_models.checkpoint'
+
+# Write the models of a whole chunk with a single statement.
+QUERY_UPDATE = """UPDATE "user" SET model = v.model
+    FROM (VALUES %s) AS v(id, model) WHERE "user".id = v.id"""
+
+
+def user_ids(store, condition, chunk_size=CHUNK_SIZE, start=0):
+    """Yield the IDs of the users that match the condition, by chunks."""
+    last = start
+    while True:
+        ids = list(store.find(User.id, condition & (User.id > last))
+                .order_by(User.id)[:chunk_size])
+        if len(ids) == 0:
+            return
+        yield ids
+        last = ids[-1]
+
+
+def fetch_chunk(store, ids):
+    """Get the current models and the points of the users.
+
+    Returns a list of (user ID, encoded model, points). The features of all
+    the users' tracks are fetched with a single query.
+    """
+    features = dict((uid, list()) for uid in ids)
+    rows = store.find((LibEntry.user_id, Track.features),
+            LibEntry.track_id == Track.id, LibEntry.user_id.is_in(ids),
+            LibEntry.is_local, LibEntry.is_valid, Track.features != None)
+    for uid, feats in rows:
+        features[uid].append(feats)
+    models = dict(store.find((User.id, User.model), User.id.is_in(ids)))
+    return [(uid, models[uid], predict.to_points(
+            uutils.decode_features_many(features[uid], predict.DIMENSIONS)))
+            for uid in ids]
+
+
+def fit(task):
+    """Fit the model of a user (runs in the pool's processes)."""
+    uid, encoded, points = task
+    prev = predict.decode_model(encoded) if encoded is not None else None
+    try:
+        params, fit_times = predict.select_model(points, prev=prev)
+    except Exception as ex:
+        # Keep the current model.
+        return uid, encoded, "error: %r" % ex
+    if params is None:
+        return uid, None, "not enough points"
+    version = predict.next_version(encoded)
+    return uid, predict.encode_model(params, version), "%d components" % (
+            len(params.weights))
+
+
+def write_models(store, results):
+    """Write the models of a chunk, in a single transaction."""
+    values = ", ".join(["(?, ?)"] * len(results))
+    params = list()
+    for uid, encoded, msg in results:
+        params.extend((uid, encoded))
+    store.execute(QUERY_UPDATE % values, params)
+    store.commit()
+
+
+def update_models(store, condition, pool, chunk_size=CHUNK_SIZE,
+        checkpoint=None, start=0, verbose=False):
+    total = store.find(User, condition & (User.id > start)).count()
+    count = 0
+    begin = time.time()
+    for ids in user_ids(store, condition, chunk_size, start):
+        tasks = fetch_chunk(store, ids)
+        # The fetch transaction shouldn't stay open while we fit the models.
+        store.rollback()
+        results = sorted(pool.imap_unordered(fit, tasks))
+        write_models(store, results)
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, ids[-1])
+        if verbose:
+            for uid, encoded, msg in results:
+                print "user %d: %s" % (uid, msg)
+        count += len(ids)
+        elapsed = time.time() - begin
+        print "%d/%d users processed (%.1f users/s)" % (
+                count, total, count / elapsed)
+    return count
+
+
+def load_checkpoint(path):
+    """Get the ID of the last user written, or 0 if there's no checkpoint."""
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return int(f.read())
+
+
+def save_checkpoint(path, uid):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write("%d\n" % uid)
+    # Atomic, the checkpoint is never half-written.
+    os.rename(tmp, path)
+
+
 def _parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('user', nargs='*', type=int)
     parser.add_argument('--null', action='store_true')
     parser.add_argument('--all', action='store_true')
+    parser.add_argument('--procs', type=int,
+            default=multiprocessing.cpu_count())
+    parser.add_argument('--chunk', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--checkpoint', default=CHECKPOINT_PATH)
+    # Start after the last user of the checkpoint.
+    parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     args = _parse_args()
-    store = uutils.get_store()
-    users = set()
-    for uid in args.user:
-        user = store.get(User, uid)
-        if user is not None:
-            users.add(user)
     if args.all:
-        users.update(store.find(User))
+        condition = (User.id != None)
     elif args.null:
-        users.update(store.find(User, User.model == None))
-    for user in users:
-        print "updating model for user %s..." % user.email
-        model = predict.Model(user)
-        model.generate(store)
-        print "    ... %d components" % model.get_nb_components()
-    store.commit()
+        condition = (User.model == None)
+    else:
+        condition = User.id.is_in(args.user)
+    start = load_checkpoint(args.checkpoint) if args.resume else 0
+    if start > 0:
+        print "resuming after user %d" % start
+    store = uutils.get_store()
+    pool = multiprocessing.Pool(args.procs)
+    update_models(store, condition, pool, chunk_size=args.chunk,
+            checkpoint=args.checkpoint, start=start, verbose=args.verbose)
+    # The run is complete, there's nothing left to resume.
+    if os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
@@ -94,7 +94,7 @@ class Fetcher(threading.Thread):
         """Store a track's tags in the database."""
         track.tags = json.dumps(tags).decode('utf-8')
         if features is not None:
-            track.features = uutils.encode_features(features)
+            track.features = features
         self._store.commit()
 
     def _track_info(self, meta):
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Train the users' models in the background.
+
+This script processes the model training jobs that are enqueued when the
+users' libraries change (see libunison/jobs.py). Fitting the models is CPU
+bound, so the jobs are processed by several worker processes.
+"""
+
+import argparse
+import libunison.jobs as jobs
+import libunison.utils as uutils
+import logging
+import multiprocessing
+import signal
+
+
+CONFIG = uutils.get_config()
+
+
+def work(interval, nb_procs):
+    """Process jobs until killed (runs in its own process)."""
+    logger = _get_logger()
+    store = uutils.get_store(CONFIG['database']['string'])
+    queue = jobs.get_queue(CONFIG, store)
+    # The candidate models of a user are fitted in parallel.
+    pool = multiprocessing.Pool(nb_procs) if nb_procs > 1 else None
+    logger.info("worker started, using queue '%s' and %d processes"
+            % (CONFIG.get('training', {}).get('queue', 'database'), nb_procs))
+    worker = jobs.Worker(queue, store, logger, interval, pool, batch=nb_procs)
+    # No need for a thread, the process is dedicated to the worker.
+    worker.run()
+
+
+def _parse_args():
+    workers = CONFIG.get('training', {}).get('workers', 1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=workers)
+    # Number of processes used by each worker to fit the candidate models.
+    parser.add_argument('--procs', type=int,
+            default=max(1, multiprocessing.cpu_count() // workers))
+    parser.add_argument('--interval', type=float, default=jobs.POLL_INTERVAL)
+    return parser.parse_args()
+
+
+def _get_logger():
+    formatter = logging.Formatter(
+            '%(asctime)s: %(levelname)s [%(process)d] - %(message)s')
+    handler = logging.StreamHandler()  # Log to stderr.
+    handler.setFormatter(formatter)
+    logger = logging.getLogger('trainer')
+    logger.setLevel(logging.DEBUG)
+    if not logger.handlers:
+        logger.addHandler(handler)
+    return logger
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    if CONFIG.get('training', {}).get('queue') == 'local':
+        raise SystemExit("the local queue is processed by the API itself")
+    processes = [multiprocessing.Process(target=work,
+            args=(args.interval, args.procs))
+            for i in xrange(args.workers)]
+    for process in processes:
+        process.start()
+    # Take the workers down with us (e.g. when stopped by the init script).
+    signal.signal(signal.SIGTERM,
+            lambda signum, frame: [p.terminate() for p in processes])
+    for process in processes:
+        process.join()
@@ -1,33 +1,17 @@
+import libunison.lifecycle as lifecycle
 import libunison.password as password
 import libunison.mail as mail
 import time
 import urllib
-import yaml
 
 from flask import Flask, render_template, request, g, redirect, url_for
 from libunison.models import User
-from storm.locals import create_database, Store
 
 
 app = Flask(__name__)
 
 
-@app.before_request
-def setup_request():
-    # Read the configuration.
-    stream = open('%s/config.yaml' % request.environ['UNISON_ROOT'])
-    g.config = yaml.load(stream)
-    # Set up the database.
-    database = create_database(g.config['database']['string'])
-    g.store = Store(database)
-
-
-@app.after_request
-def teardown_request(response):
-    # Commit & close the database connection.
-    g.store.commit()
-    g.store.close()
-    return response
+lifecycle.init_app(app)
 
 
 @app.route('/')